@@ -19,7 +19,8 @@ setup(
         'Programming Language :: Python',
         'Topic :: Software Development',
     ],
-    packages=['stdimage'],
+    packages=['stdimage', 'stdimage.management', 'stdimage.management.commands',
+              'stdimage.templatetags'],
     include_package_data=True,
     requires=['django (>=1.0)',],
 )
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""Engines doing the pixel work of StdImageField.
+
+An engine opens encoded images, resizes them and encodes the result. The
+images it returns are opaque to the field, which only asks the engine for
+their size. The engine is selected with the `engine` option of the field or
+the STDIMAGE_ENGINE setting, PILEngine being the default.
+
+"""
+import os
+from StringIO import StringIO
+
+from django.conf import settings
+
+from utils import get_object
+
+_engines = {}
+
+# Formats of the usual image file extensions
+FORMATS = {
+    '.gif': 'GIF',
+    '.jpeg': 'JPEG',
+    '.jpg': 'JPEG',
+    '.png': 'PNG',
+    '.tif': 'TIFF',
+    '.tiff': 'TIFF',
+    '.webp': 'WEBP',
+}
+
+# File extensions of the formats
+EXTENSIONS = {
+    'GIF': '.gif',
+    'JPEG': '.jpeg',
+    'PNG': '.png',
+    'TIFF': '.tiff',
+    'WEBP': '.webp',
+}
+
+
+def get_size(img_size, size):
+    """Returns the size of an image of `img_size` once resized to `size`, a
+    dictionary with width, height and force: forced sizes are exact, the
+    image being cropped, others are the biggest size fitting in them without
+    cropping. All the engines produce images of this size.
+
+    """
+    if size['force']:
+        return size['width'], size['height']
+    width, height = img_size
+    if width > size['width']:
+        height = max(height * size['width'] // width, 1)
+        width = size['width']
+    if height > size['height']:
+        width = max(width * size['height'] // height, 1)
+        height = size['height']
+    return width, height
+
+
+def get_crop_box(img_size, size):
+    """Returns the (left, top, width, height) centered box of an image of
+    `img_size` having the aspect ratio of `size`
+
+    """
+    width, height = img_size
+    ratio = float(size[0]) / size[1]
+    if float(width) / height > ratio:
+        crop_width, crop_height = int(round(height * ratio)), height
+    else:
+        crop_width, crop_height = width, int(round(width / ratio))
+    return ((width - crop_width) // 2, (height - crop_height) // 2,
+            crop_width, crop_height)
+
+
+class BaseEngine(object):
+    """Interface of the engines"""
+
+    # Exceptions raised on images that can not be read or decoded
+    errors = (IOError, OSError)
+
+    def open(self, content):
+        """Returns the image encoded in `content`, reading its header only"""
+        raise NotImplementedError
+
+    def load(self, img, sizes=()):
+        """Decodes `img` and returns it. The engine may decode it at a
+        reduced scale, as long as the result still covers all the `sizes`.
+
+        """
+        raise NotImplementedError
+
+    def get_size(self, img):
+        """Returns the (width, height) of `img`"""
+        raise NotImplementedError
+
+    def reduces_on_load(self, img):
+        """Returns True if `load` can decode `img` at a reduced scale"""
+        return False
+
+    def resize(self, img, size, crop=False):
+        """Returns a copy of `img` resized to exactly `size`. If `crop` is
+        True, the image is cropped around its center to the aspect ratio of
+        `size` first.
+
+        """
+        raise NotImplementedError
+
+    def save(self, img, format, **options):
+        """Returns the content of `img` encoded in the given format. Options,
+        ignored by the formats not supporting them:
+            - quality: encoding quality, from 1 to 100 (JPEG and WEBP)
+            - progressive: if True, the image is encoded progressively (JPEG)
+            - subsampling: chroma subsampling, 0 or '4:4:4' to disable it,
+            1 or '4:2:2', 2 or '4:2:0' (JPEG)
+            - strip: if False, the EXIF data and ICC profile of the image are
+            kept (they are stripped by default)
+
+        """
+        raise NotImplementedError
+
+    def get_format(self, filename):
+        """Returns the format matching the extension of `filename`"""
+        raise NotImplementedError
+
+
+class PILEngine(BaseEngine):
+    """Engine based on PIL (or Pillow)"""
+
+    def __init__(self):
+        try:
+            import Image, ImageOps
+        except ImportError:
+            from PIL import Image, ImageOps
+        self.Image, self.ImageOps = Image, ImageOps
+
+    def open(self, content):
+        return self.Image.open(StringIO(content))
+
+    def load(self, img, sizes=()):
+        # Let JPEG images decode directly at 1/2, 1/4 or 1/8 of their size
+        if img.format == 'JPEG' and sizes:
+            img.draft(img.mode, (max([s[0] for s in sizes]),
+                                 max([s[1] for s in sizes])))
+        img.load()
+        return img
+
+    def get_size(self, img):
+        return img.size
+
+    def reduces_on_load(self, img):
+        return img.format == 'JPEG'
+
+    def resize(self, img, size, crop=False):
+        Image = self.Image
+        #If the image is big, shrink it by an integer factor averaging the
+        #pixels first, keeping at least twice the final size
+        factor = min(img.size[0] // size[0], img.size[1] // size[1]) // 2
+        if factor > 1 and img.mode not in ('1', 'P'):
+            if hasattr(img, 'reduce'):
+                img = img.reduce(factor)
+            elif hasattr(Image, 'BOX'):
+                img = img.resize((img.size[0] // factor, img.size[1] // factor),
+                                 Image.BOX)
+        if crop:
+            return self.ImageOps.fit(img, size, Image.ANTIALIAS)
+        return img.resize(size, Image.ANTIALIAS)
+
+    def save(self, img, format, **options):
+        params = {}
+        if format in ('JPEG', 'WEBP') and options.get('quality'):
+            params['quality'] = options['quality']
+        if format == 'JPEG':
+            if options.get('progressive'):
+                params['progressive'] = True
+            if options.get('subsampling') is not None:
+                params['subsampling'] = options['subsampling']
+            if img.mode not in ('RGB', 'L', 'CMYK'):
+                img = img.convert('RGB')
+        if not options.get('strip', True):
+            for key in ('exif', 'icc_profile'):
+                if img.info.get(key):
+                    params[key] = img.info[key]
+        buf = StringIO()
+        try:
+            img.save(buf, format, optimize=1, **params)
+        except IOError:
+            buf = StringIO()
+            img.save(buf, format, **params)
+        return buf.getvalue()
+
+    def get_format(self, filename):
+        self.Image.init()
+        return self.Image.EXTENSION[os.path.splitext(filename)[1].lower()]
+
+
+class VipsImage(object):
+    """A libvips image, with the content it was opened from"""
+
+    def __init__(self, image, content):
+        self.image = image
+        self.content = content
+
+
+class VipsEngine(BaseEngine):
+    """Engine based on libvips, through pyvips. Faster and lighter on memory
+    than PIL for big images.
+
+    """
+
+    suffixes = {
+        'GIF': '.gif',
+        'JPEG': '.jpg',
+        'PNG': '.png',
+        'TIFF': '.tif',
+        'WEBP': '.webp',
+    }
+
+    def __init__(self):
+        import pyvips
+        self.pyvips = pyvips
+        self.errors = BaseEngine.errors + (pyvips.Error,)
+
+    def open(self, content):
+        return VipsImage(self.pyvips.Image.new_from_buffer(content, ''), content)
+
+    def load(self, img, sizes=()):
+        image = img.image
+        if sizes and image.get('vips-loader').startswith('jpegload'):
+            # Let libjpeg decode the image directly at a reduced scale
+            shrink = min(image.width // max([s[0] for s in sizes]),
+                         image.height // max([s[1] for s in sizes]))
+            shrink = max([s for s in (1, 2, 4, 8) if s <= max(shrink, 1)])
+            if shrink > 1:
+                image = self.pyvips.Image.new_from_buffer(img.content, '',
+                                                          shrink=shrink)
+        return VipsImage(image.copy_memory(), img.content)
+
+    def get_size(self, img):
+        return img.image.width, img.image.height
+
+    def reduces_on_load(self, img):
+        return img.image.get('vips-loader').startswith('jpegload')
+
+    def resize(self, img, size, crop=False):
+        image = img.image
+        if crop:
+            image = image.crop(*get_crop_box((image.width, image.height), size))
+        return VipsImage(image.thumbnail_image(size[0], height=size[1],
+                                               size='force'), img.content)
+
+    def save(self, img, format, **options):
+        params = {'strip': options.get('strip', True)}
+        if format in ('JPEG', 'WEBP') and options.get('quality'):
+            params['Q'] = options['quality']
+        if format == 'JPEG':
+            if options.get('progressive'):
+                params['interlace'] = True
+            if options.get('subsampling') in (0, '4:4:4'):
+                params['no_subsample'] = True
+        return img.image.write_to_buffer(self.suffixes[format], **params)
+
+    def get_format(self, filename):
+        return FORMATS[os.path.splitext(filename)[1].lower()]
+
+
+def get_engine(engine=None):
+    """Returns the engine for `engine`, that can be an engine instance or
+    class, or the dotted path of any of them. Defaults to the STDIMAGE_ENGINE
+    setting.
+
+    """
+    if engine is None:
+        engine = getattr(settings, 'STDIMAGE_ENGINE', 'stdimage.engines.PILEngine')
+    key = engine if isinstance(engine, basestring) else id(engine)
+    if key not in _engines:
+        _engines[key] = get_object(engine)
+    return _engines[key]
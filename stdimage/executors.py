@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""Executors used to render variations outside of the request that saved
+the image (see the `render_async` option of StdImageField).
+
+An executor is any object with a `submit(fn, *args, **kwargs)` method. A
+plain callable is accepted as well; it will be called with the job function
+and its arguments, so it can hand them over to a job queue.
+
+"""
+import logging
+import multiprocessing
+import Queue
+import threading
+
+from django.conf import settings
+from django.db.models import get_model
+
+from locks import get_lock
+from utils import get_object
+
+logger = logging.getLogger('stdimage')
+
+_executors = {}
+
+
+def render_variations(app_label, model_name, field_name, name):
+    """Job rendering the variations of the image `name` stored by the given
+    field. Only needs picklable arguments, so it can run on other processes.
+
+    """
+    field = get_model(app_label, model_name)._meta.get_field(field_name)
+    lock = get_lock(name)
+    lock.acquire()
+    try:
+        field._render_variations(name)
+    finally:
+        lock.release()
+
+
+class SyncExecutor(object):
+    """Runs the jobs as soon as they are submitted"""
+
+    def submit(self, fn, *args, **kwargs):
+        fn(*args, **kwargs)
+
+    def flush(self):
+        pass
+
+
+class ThreadExecutor(object):
+    """Runs the jobs on a pool of daemon threads"""
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or getattr(settings, 'STDIMAGE_MAX_WORKERS', 2)
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        self._lock.acquire()
+        try:
+            while len(self._threads) < self.max_workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        finally:
+            self._lock.release()
+
+    def _work(self):
+        while True:
+            fn, args, kwargs = self._queue.get()
+            try:
+                fn(*args, **kwargs)
+            except Exception:
+                logger.exception('Error rendering image variations')
+            finally:
+                self._queue.task_done()
+
+    def submit(self, fn, *args, **kwargs):
+        self._start()
+        self._queue.put((fn, args, kwargs))
+
+    def flush(self):
+        self._queue.join()
+
+
+class ProcessExecutor(object):
+    """Runs the jobs on a pool of processes"""
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or getattr(settings, 'STDIMAGE_MAX_WORKERS', None)
+        self._pool = None
+        self._results = []
+
+    def submit(self, fn, *args, **kwargs):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.max_workers)
+        self._results.append(self._pool.apply_async(fn, args, kwargs))
+
+    def flush(self):
+        results, self._results = self._results, []
+        for result in results:
+            result.get()
+
+
+class CallableExecutor(object):
+    """Hands the jobs over to a user supplied callable"""
+
+    def __init__(self, func):
+        self.func = func
+
+    def submit(self, fn, *args, **kwargs):
+        self.func(fn, *args, **kwargs)
+
+    def flush(self):
+        pass
+
+
+def get_executor(executor=None):
+    """Returns the executor for `executor`, that can be an executor instance,
+    a callable or the dotted path of any of them. Defaults to the
+    STDIMAGE_EXECUTOR setting.
+
+    """
+    if executor is None:
+        executor = getattr(settings, 'STDIMAGE_EXECUTOR',
+                           'stdimage.executors.ThreadExecutor')
+    key = executor if isinstance(executor, basestring) else id(executor)
+    if key not in _executors:
+        obj = get_object(executor)
+        if not hasattr(obj, 'submit'):
+            obj = CallableExecutor(obj)
+        _executors[key] = obj
+    return _executors[key]
+
+
+def flush():
+    """Waits until all the submitted jobs are done"""
+    for executor in _executors.values():
+        executor.flush()
@@ -1,15 +1,47 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import math
+import multiprocessing
 import os
-import shutil
+import re
+import sys
 from warnings import warn
 
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
 from django.conf import settings
-from django.core.files.storage import FileSystemStorage
+from django.core.files.base import ContentFile, File
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.core.urlresolvers import reverse
+from django.db import connections, router, transaction
+from django.db.models import get_models
 from django.db.models import signals
-from django.db.models.fields.files import ImageField, ImageFileDescriptor
+from django.db.models.fields.files import FieldFile, ImageField, ImageFieldFile
+from django.utils.encoding import filepath_to_uri
+from engines import EXTENSIONS, get_engine, get_size
+from executors import get_executor, render_variations
+from locks import get_lock
+from metadata import delete_metadata, get_many, get_metadata, set_metadata
+from metrics import get_timer
+from utils import clean_temp_files, make_directory, run_in_threads, write_atomic
 from forms import StdImageFormField
 from widgets import DelAdminFileWidget
 
+# Variation options passed to the engine when encoding
+SAVE_OPTIONS = ('quality', 'progressive', 'subsampling', 'strip')
+
+
+# Name of the images stored under the hash of their content
+CONTENT_NAME_RE = re.compile(r'(^|/)([0-9a-f]{2})/\2[0-9a-f]{38}\.[^./]+$')
+
+
+class ImageTooLarge(Exception):
+    """Raised when rendering an image over the budget of its field"""
+
 
 class ThumbnailField(object):
     """Instances of this class will be used to access data of the
@@ -17,10 +49,10 @@ class ThumbnailField(object):
 
     """
 
-    def __init__(self, name):
+    def __init__(self, name, storage=None):
         warn('%(class)s has been deprecated in favor of VariationsField()', DeprecationWarning)
         self.name = name
-        self.storage = FileSystemStorage()
+        self.storage = storage or default_storage
 
     def path(self):
         return self.storage.path(self.name)
@@ -38,9 +70,11 @@ class VariationField(object):
 
     """
 
-    def __init__(self, name):
+    def __init__(self, name, storage=None, url=None):
         self.name = name
-        self.storage = FileSystemStorage()
+        self.storage = storage or default_storage
+        self._url = url
+        self._metadata = None
 
     @property
     def path(self):
@@ -48,22 +82,160 @@ class VariationField(object):
 
     @property
     def url(self):
+        if self._url is not None:
+            return self._url
         return self.storage.url(self.name)
 
+    @property
+    def metadata(self):
+        """Dictionary with the byte size, width, height, format and
+        modification time of the variation, None if it does not exist. Kept
+        in the cache when the variation is rendered.
+
+        """
+        if self._metadata is None:
+            self._metadata = get_metadata(self.name, self.storage)
+        return self._metadata
+
+    @property
+    def exists(self):
+        return self.metadata is not None
+
     @property
     def size(self):
-        return self.storage.size(self.name)
+        # Only the cached size is used, dimensions are not read for it
+        metadata = self._metadata or get_metadata(self.name, self.storage, read=False)
+        if metadata is None:
+            return self.storage.size(self.name)
+        return metadata['size']
+
+    @property
+    def width(self):
+        return self.metadata and self.metadata['width']
+
+    @property
+    def height(self):
+        return self.metadata and self.metadata['height']
+
+    @property
+    def format(self):
+        return self.metadata and self.metadata['format']
+
+    @property
+    def modified(self):
+        return self.metadata and self.metadata['modified']
 
 
-class StdImageFileDescriptor(ImageFileDescriptor):
-    """ The thumbnail property of the field should be accessible in instance
-    cases
+class StdImageFieldFile(ImageFieldFile):
+    """ The variations of the image are accessible as attributes, they are
+    created on first access and kept for the lifetime of the file
 
     """
 
-    def __set__(self, instance, value):
-        super(StdImageFileDescriptor, self).__set__(instance, value)
-        self.field.set_variations(instance)
+    def __getattr__(self, name):
+        field = self.__dict__.get('field')
+        if name.startswith('_') or field is None or not self.name:
+            raise AttributeError(name)
+        variations = self.__dict__.setdefault('_variations', {})
+        key = (name, self.name)
+        if key not in variations:
+            for variation in field.variations:
+                if variation['name'] == name and name != 'size':
+                    break
+            else:
+                raise AttributeError(name)
+            url = field._get_variation_url(variation, self.name)
+            variations[key] = VariationField(
+                field._get_variation_filename(variation, self.name),
+                self.storage, url)
+            webp_filename = field._get_webp_filename(variation, self.name)
+            if webp_filename:
+                variations[key].webp = VariationField(
+                    webp_filename, self.storage, url and url + '?format=webp')
+        return variations[key]
+
+    @property
+    def srcset(self):
+        """The srcset attribute of an img element, listing the variations of
+        the width ladder of the field (see the `srcset` option) with their
+        actual width. Widths are read from the cached metadata in one call,
+        and from the storage for the variations missing from the cache;
+        variations not rendered yet get the width they will have.
+
+        """
+        cached = self.__dict__.get('_srcset')
+        if cached is None or cached[0] != self.name:
+            variations = [getattr(self, v['name']) for v in self.field.srcset]
+            metadata = get_many([v.name for v in variations], self.storage)
+            entries = []
+            widths = set()
+            for variation_field, variation in zip(variations, self.field.srcset):
+                if variation_field.name in metadata:
+                    variation_field._metadata = metadata[variation_field.name]
+                if variation_field.metadata is not None:
+                    width = variation_field.metadata['width']
+                else:
+                    width = get_size((self.width, self.height), variation)[0]
+                # Images narrower than the ladder give copies of the same width
+                if width not in widths:
+                    widths.add(width)
+                    entries.append('%s %dw' % (variation_field.url, width))
+            cached = self.__dict__['_srcset'] = (self.name, ', '.join(entries))
+        return cached[1]
+
+    def save(self, name, content, save=True):
+        """Saves the file like FieldFile.save, keeping this file object on
+        the instance. The size of the image checked by StdImageFormField is
+        kept, and the bytes of uploads held in memory are kept for rendering,
+        so they are not read again from the storage. Unless variations are rendered
+        asynchronously, images bigger than the `size` of the field are
+        resized in memory before they are saved.
+
+        """
+        name = self.field.generate_filename(self.instance, name)
+        upload = content
+        if isinstance(content, FieldFile):
+            # Uploads from forms are wrapped by the file of the field. The
+            # upload itself is used, it has the image size set by the form
+            # and the storage moves temporary uploads into place
+            upload = content.file
+        if self.field.size and not self.field.render_async:
+            resized = self.field._resize_upload(name, upload)
+            if resized is not None:
+                upload = resized
+        self.name = self.storage.save(name, upload)
+        if getattr(upload, 'image_size', None):
+            self._dimensions_cache = upload.image_size
+        if isinstance(upload, (ContentFile, InMemoryUploadedFile)):
+            # The content is copied now, the caller may close it before the
+            # instance is saved
+            try:
+                upload.seek(0)
+                self._upload = upload.read()
+            except ValueError:
+                pass
+        if isinstance(content, FieldFile):
+            # The upload may have been moved or resized, the file is opened
+            # from the storage when needed
+            self._file = None
+        self._uploaded = True
+        setattr(self.instance, self.field.name, self)
+
+        # Update the filesize cache
+        self._size = upload.size
+        self._committed = True
+
+        # Save the object because it has changed, unless save is False
+        if save:
+            self.instance.save()
+    save.alters_data = True
+
+    def _read_upload(self):
+        """Returns the content of the in memory upload saved in this file,
+        or None
+
+        """
+        return self.__dict__.pop('_upload', None)
 
 
 class StdImageField(ImageField):
@@ -74,7 +246,7 @@ class StdImageField(ImageField):
 
     """
 
-    descriptor_class = StdImageFileDescriptor
+    attr_class = StdImageFieldFile
 
     def __init__(self, *args, **kwargs):
 
@@ -86,6 +258,42 @@ class StdImageField(ImageField):
                 for forcing te image to have the desired size
             - thumbnail_size: a tuple with same values than `size'
             (None for not creating a thumbnail
+            - variations: a dictionary of variations by name. Each one is a
+            tuple like `size', with an optional dictionary of options as
+            fourth item, or a dictionary with width, height, force and the
+            options:
+                * format: the format of the variation ('JPEG', 'PNG',
+                'WEBP'...), the format of the image by default
+                * quality, progressive, subsampling, strip: encoder options
+                (see stdimage.engines.BaseEngine.save)
+                * webp: if True (or a dictionary of encoder options), a WebP
+                copy of the variation is rendered too
+                * Example: {'thumbnail': (100, 100, True, {'quality': 80,
+                'webp': True})}
+            - render_async: if True, variations are rendered by an executor
+            after the image is saved instead of during the save
+            - executor: the executor used by render_async, an executor
+            instance, a callable or a dotted path to any of them (defaults to
+            the STDIMAGE_EXECUTOR setting)
+            - engine: the engine resizing the images, an engine instance or
+            class or a dotted path to any of them (defaults to the
+            STDIMAGE_ENGINE setting)
+            - render_on_demand: if True, variations are not rendered when the
+            image is saved, their url points to a view rendering them on
+            first request (include stdimage.urls in your urlconf)
+            - srcset: a tuple of widths, like (320, 640, 1280). A variation
+            of each width and any height is rendered (named w320, w640...),
+            the `srcset' attribute of the image lists them
+            - srcset_options: options of the variations of srcset, like
+            {'quality': 80, 'webp': True}
+            - content_addressed: if True, images are named after the SHA-1
+            of their content and the variations of the field
+            (<upload_to>/<2 first digits>/<SHA-1>.<ext>), so identical
+            uploads share the same files, rendered once, and deleted with
+            the last object using them
+            - max_pixels, max_bytes: budget of the uploaded images, bigger
+            ones are rejected by the form field (defaults to the
+            STDIMAGE_MAX_PIXELS and STDIMAGE_MAX_BYTES settings)
 
         """
         size = kwargs.pop('size', None)
@@ -95,7 +303,13 @@ class StdImageField(ImageField):
 
         param_size = ('width', 'height', 'force')
 
-        variations = kwargs.pop('variations', {})
+        variations = dict(kwargs.pop('variations', {}))
+        srcset = kwargs.pop('srcset', ())
+        srcset_options = kwargs.pop('srcset_options', {})
+        for width in srcset:
+            # Variations of the ladder have an unconstrained height
+            variations['w%d' % width] = dict(srcset_options, width=width,
+                                             height=sys.maxint, force=False)
         if not variations.has_key('size'):
             variations['size'] = size
         if not variations.has_key('thumbnail'):
@@ -104,14 +318,30 @@ class StdImageField(ImageField):
         var = []
 
         for key, attr in variations.iteritems():
-            if attr and isinstance(attr, (tuple, list)):
-                variation = dict(map(None, param_size, attr))
+            if attr and isinstance(attr, (tuple, list, dict)):
+                if isinstance(attr, dict):
+                    variation = dict(attr)
+                    variation.setdefault('force', None)
+                else:
+                    variation = dict(map(None, param_size, attr[:3]))
+                    if len(attr) > 3:
+                        variation.update(attr[3])
+                if variation.get('format'):
+                    variation['format'] = variation['format'].upper()
                 variation['name'] = key
                 setattr(self, key, variation)
                 var.append(variation)
             else:
                 setattr(self, key, None)
         self.variations = var
+        self.srcset = [getattr(self, 'w%d' % width) for width in sorted(srcset)]
+        self.render_async = kwargs.pop('render_async', False)
+        self.executor = kwargs.pop('executor', None)
+        self.engine = kwargs.pop('engine', None)
+        self.render_on_demand = kwargs.pop('render_on_demand', False)
+        self.content_addressed = kwargs.pop('content_addressed', False)
+        self.max_pixels = kwargs.pop('max_pixels', None)
+        self.max_bytes = kwargs.pop('max_bytes', None)
         super(StdImageField, self).__init__(*args, **kwargs)
 
     @staticmethod
@@ -137,75 +367,627 @@ class StdImageField(ImageField):
         """
         splitted_filename = list(os.path.splitext(filename))
         splitted_filename.insert(1, '.%s' % variation['name'])
+        if variation.get('format'):
+            splitted_filename[2] = EXTENSIONS[variation['format']]
         return ''.join(splitted_filename)
 
-    def _resize_image(self, filename, size):
-        """Resizes the image to specified width, height and force option
+    def _get_webp_filename(self, variation, filename):
+        """Returns the filename of the WebP copy of the variation, or None if
+        the variation has none
+
+        """
+        if not variation.get('webp') or variation.get('format') == 'WEBP':
+            return None
+        return self._get_variation_filename(dict(variation, format='WEBP'), filename)
+
+    def _get_variation_filenames(self, filename):
+        """Returns the filenames of all the variations of the standard image
+        filename, WebP copies included
+
+        """
+        filenames = []
+        for variation in self.variations:
+            if variation['name'] != 'size':
+                filenames.append(self._get_variation_filename(variation, filename))
+                webp_filename = self._get_webp_filename(variation, filename)
+                if webp_filename:
+                    filenames.append(webp_filename)
+        return filenames
+
+    def _get_variation_url(self, variation, filename):
+        """Returns the url of the view rendering the variation on demand, or
+        None if the variation is rendered when the image is saved
+
+        """
+        if not self.render_on_demand:
+            return None
+        return reverse('stdimage-variation', kwargs={
+            'app_label': self.model._meta.app_label,
+            'model_name': self.model._meta.object_name,
+            'field_name': self.name,
+            'variation_name': variation['name'],
+            'name': filename,
+        })
+
+    @staticmethod
+    def _needs_resize(img_size, size):
+        """Returns True if an image of `img_size` does not fit in the given
+        size
+
+        """
+        return img_size[0] > size['width'] or img_size[1] > size['height']
+
+    @staticmethod
+    def _get_save_options(variation, webp=False):
+        """Returns the encoder options of the variation, the ones of its
+        WebP copy if `webp` is True
+
+        """
+        options = dict([(k, variation[k]) for k in SAVE_OPTIONS if k in variation])
+        if webp and isinstance(variation.get('webp'), dict):
+            options.update(variation['webp'])
+        return options
+
+    def _get_budget_size(self, engine, img, content):
+        """Checks the image `img` encoded in `content` against the pixel and
+        byte budgets of the field before it is decoded. Returns None if it
+        fits, or the size to ask the engine to decode it at so the decoded
+        image fits, if the engine can decode it at a reduced scale. Raises
+        ImageTooLarge otherwise.
+
+        """
+        max_bytes = self.max_bytes or getattr(settings, 'STDIMAGE_MAX_BYTES', None)
+        if max_bytes and len(content) > max_bytes:
+            raise ImageTooLarge('The image has %d bytes, the budget is %d' % (
+                len(content), max_bytes))
+        max_pixels = self.max_pixels or getattr(settings, 'STDIMAGE_MAX_PIXELS', None)
+        width, height = engine.get_size(img)
+        if not max_pixels or width * height <= max_pixels:
+            return None
+        ratio = math.sqrt(float(max_pixels) / (width * height))
+        # Reduced decoding divides the size by up to 8, and gives an image
+        # less than twice as big as the requested size
+        if ratio >= 0.125 and engine.reduces_on_load(img):
+            return (max(int(width * ratio) // 2, 1),
+                    max(int(height * ratio) // 2, 1))
+        raise ImageTooLarge('The image has %d pixels, the budget is %d' % (
+            width * height, max_pixels))
+
+    def _needs_encode(self, variation, format):
+        """Returns True if the variation can not be a copy of an image of
+        the given format that does not need resizing
+
+        """
+        return (variation.get('format', format) != format or
+                bool(self._get_webp_filename(variation, '')) or
+                bool(self._get_save_options(variation)))
+
+    def _write(self, name, content):
+        """Writes `content` to the storage of the field as `name`, replacing
+        any existing file. Files of storages with paths are replaced
+        atomically, so they can be served while variations are rendered.
+
+        """
+        try:
+            path = self.storage.path(name)
+        except NotImplementedError:
+            if self.storage.exists(name):
+                self.storage.delete(name)
+            self.storage.save(name, ContentFile(content))
+        else:
+            write_atomic(path, content)
+
+    def _delete(self, name):
+        """Deletes the file `name` from the storage of the field, if it
+        exists
+
+        """
+        try:
+            self.storage.delete(name)
+        except Exception:
+            # Storages may fail on missing files, deleted concurrently or
+            # never written
+            if self.storage.exists(name):
+                raise
+
+    def _get_upload_directory(self):
+        """Returns the fixed part of the upload directory of the field: the
+        directories named after the date are below it, and it is the root of
+        the storage if upload_to is callable
+
+        """
+        if callable(self.upload_to):
+            return ''
+        directory = self.upload_to
+        if '%' in directory:
+            directory = os.path.dirname(directory.split('%')[0])
+        return os.path.normpath(directory) if directory else ''
+
+    def _clean_temp_files(self, max_age=None):
+        """Removes the temporary files left by interrupted writes under the
+        upload directory of the field (see stdimage.utils.clean_temp_files),
+        returns their number
+
+        """
+        try:
+            path = self.storage.path(self._get_upload_directory())
+        except NotImplementedError:
+            return 0
+        return clean_temp_files(path, max_age)
+
+    def _move(self, src, dst, content=None):
+        """Renames the file `src` of the storage of the field to `dst`. On
+        storages without paths, the file is copied from its `content` if
+        given, instead of being read again.
+
+        """
+        try:
+            src_path, dst_path = self.storage.path(src), self.storage.path(dst)
+        except NotImplementedError:
+            if content is None:
+                content = self._read(src)
+            self._write(dst, content)
+            self.storage.delete(src)
+        else:
+            make_directory(os.path.dirname(dst_path))
+            os.rename(src_path, dst_path)
+
+    def _get_fingerprints_filename(self, filename):
+        """Returns the name of the file keeping the fingerprints of the
+        variations of the image `filename`
+
+        """
+        return '%s.stdimage' % filename
+
+    @staticmethod
+    def _get_fingerprint(source_fingerprint, variation):
+        """Returns the fingerprint of a variation rendered from an image with
+        the given fingerprint
+
+        """
+        return hashlib.sha1('%s%r' % (source_fingerprint,
+                                      sorted(variation.items()))).hexdigest()
+
+    def _read_fingerprints(self, filename):
+        """Returns the fingerprints recorded when rendering the variations of
+        the image `filename`: a dictionary with the fingerprint of the image
+        as 'source' and the ones of its variations as 'variations'
 
-        Arguments::
+        """
+        name = self._get_fingerprints_filename(filename)
+        if not self.storage.exists(name):
+            return {}
+        f = self.storage.open(name)
+        try:
+            return json.loads(f.read())
+        except ValueError:
+            return {}
+        finally:
+            f.close()
 
-        filename -- full path of image to resize
-        size -- dictionary with
-            - width: int
-            - height: int
-            - force: bool
-                if True, image will be cropped to fit the exact size,
-                if False, it will have the bigger size that fits the specified
-                size, but without cropping, so it could be smaller on width
-                or height
+    def _is_rendered(self, filename, variation, fingerprints, source_fingerprint):
+        """Returns True if the variation of `filename` exists and was rendered
+        from the image with the given fingerprint with the current options
 
         """
+        fingerprint = self._get_fingerprint(source_fingerprint, variation)
+        return (fingerprints.get('variations', {}).get(variation['name']) == fingerprint and
+                self.storage.exists(self._get_variation_filename(variation, filename)))
+
+    def _get_stale_variations(self, filename):
+        """Returns the variations of the image `filename` that are missing or
+        were rendered with other options, trusting the recorded fingerprint of
+        the image
+
+        """
+        fingerprints = self._read_fingerprints(filename)
+        return [v for v in self.variations if v['name'] != 'size' and
+                not self._is_rendered(filename, v, fingerprints,
+                                      fingerprints.get('source'))]
+
+    def _apply_size(self, engine, img, format, budget_size, timer):
+        """Decodes the image `img` and resizes it to the `size` of the field,
+        within the budget size (see _get_budget_size). Returns the resized
+        image, its size and its content encoded in the given format.
+
+        """
+        img_size = engine.get_size(img)
+        target = get_size(img_size, self.size)
+        timer.reset()
+        if budget_size:
+            img = engine.load(img, [(min(target[0], budget_size[0]),
+                                     min(target[1], budget_size[1]))])
+            img_size = engine.get_size(img)
+            target = get_size(img_size, self.size)
+        else:
+            img = engine.load(img, [target])
+        timer.lap('decode', size=engine.get_size(img))
+        img = engine.resize(img, target, self.size['force'])
+        timer.lap('resize', variation='size', format=format,
+                  input_size=img_size, output_size=target)
+        content = engine.save(img, format, **self._get_save_options(self.size))
+        timer.lap('encode', variation='size', format=format, bytes=len(content))
+        return img, engine.get_size(img), content
 
-        width, height = 0, 1
+    def _resize_upload(self, name, content):
+        """Returns the upload `content`, to be saved as `name`, resized in
+        memory to the `size` of the field, so the image is written once and
+        already resized. Returns None if the image fits, or can not be read.
+
+        """
+        image_size = getattr(content, 'image_size', None)
+        if image_size and not self._needs_resize(image_size, self.size):
+            return None
+        engine = get_engine(self.engine)
+        content.seek(0)
+        data = content.read()
+        content.seek(0)
         try:
-            import Image, ImageOps
-        except ImportError:
-            from PIL import Image, ImageOps
-        img = Image.open(filename)
-        if (img.size[width] > size['width'] or
-                    img.size[height] > size['height']):
-
-            #If the image is big resize it with the cheapest resize algorithm
-            factor = 1
-            while (img.size[0] / factor > 2 * size['width'] and
-                                   img.size[1] * 2 / factor > 2 * size['height']):
-                factor *= 2
-            if factor > 1:
-                img.thumbnail((int(img.size[0] / factor),
-                               int(img.size[1] / factor)), Image.NEAREST)
-
-            if size['force']:
-                img = ImageOps.fit(img, (size['width'], size['height']),
-                                   Image.ANTIALIAS)
+            img = engine.open(data)
+            format = engine.get_format(name)
+        except (IOError, KeyError):
+            return None
+        if not self._needs_resize(engine.get_size(img), self.size):
+            return None
+        img, img_size, data = self._apply_size(
+            engine, img, format, self._get_budget_size(engine, img, data),
+            get_timer(self, name))
+        resized = ContentFile(data)
+        resized.image_size = img_size
+        return resized
+
+    def _render_variations(self, filename, variations=None, force=False,
+                           content=None):
+        """Resizes the image stored as `filename` in the storage of the field
+        and creates its variations (all of them unless a list of variations
+        is given) decoding the image only once. Returns the list of rendered
+        variations.
+
+        Variations are rendered from the biggest to the smallest one, each of
+        them from the smallest already rendered image that still covers its
+        size, so big images are downscaled progressively.
+
+        A fingerprint of the image and the options of each variation is
+        recorded next to the image, variations already rendered from the same
+        image with the same options are skipped unless `force` is True.
+
+        The content of the image is read from the storage, unless given.
+        Images over the pixel budget of the field are decoded at a reduced
+        scale if possible, ImageTooLarge is raised otherwise. The duration
+        of each stage is reported to the metrics callback (see
+        stdimage.metrics).
+
+        """
+        engine = get_engine(self.engine)
+        timer = get_timer(self, filename)
+        if content is None:
+            source_file = self.storage.open(filename)
+            try:
+                content = source_file.read()
+            finally:
+                source_file.close()
+            timer.lap('read', bytes=len(content))
+        if variations is None:
+            variations = self.variations
+        variations = [v for v in variations if v['name'] != 'size']
+
+        img = engine.open(content)
+        img_size = engine.get_size(img)
+        format = engine.get_format(filename)
+        budget_size = self._get_budget_size(engine, img, content)
+        loaded = self.size and self._needs_resize(img_size, self.size)
+        if loaded:
+            img, img_size, content = self._apply_size(engine, img, format,
+                                                      budget_size, timer)
+            self._write(filename, content)
+            timer.lap('write', variation='size', format=format, bytes=len(content))
+
+        source_fingerprint = hashlib.sha1(content).hexdigest()
+        fingerprints = self._read_fingerprints(filename)
+        if fingerprints.get('source') != source_fingerprint:
+            fingerprints = {}
+        if not force:
+            variations = [v for v in variations if not self._is_rendered(
+                filename, v, fingerprints, source_fingerprint)]
+        if not variations:
+            return variations
+
+        # Sorted by the size they get from this image, as the variations of
+        # the width ladder have no height limit
+        def get_area(variation):
+            width, height = get_size(img_size, variation)
+            return width * height
+        variations.sort(key=get_area, reverse=True)
+        if not loaded:
+            sizes = []
+            for variation in variations:
+                if self._needs_resize(img_size, variation):
+                    sizes.append(get_size(img_size, variation))
+                elif self._needs_encode(variation, format):
+                    sizes.append(img_size)
+            # Variations that are copies of the image need no decoding
+            if sizes or budget_size:
+                timer.reset()
+                if budget_size:
+                    sizes = [(min(s[0], budget_size[0]), min(s[1], budget_size[1]))
+                             for s in sizes] or [budget_size]
+                    img = engine.load(img, sizes)
+                    img_size = engine.get_size(img)
+                else:
+                    img = engine.load(img, sizes)
+                timer.lap('decode', size=engine.get_size(img))
+
+        sources = []
+        for variation in variations:
+            variation_filename = self._get_variation_filename(variation, filename)
+            variation_format = variation.get('format') or format
+            timer.reset()
+            if not self._needs_resize(img_size, variation):
+                if not (budget_size and not loaded or
+                        self._needs_encode(variation, format)):
+                    self._write(variation_filename, content)
+                    timer.lap('write', variation=variation['name'],
+                              format=format, bytes=len(content))
+                    set_metadata(variation_filename, self.storage, img_size,
+                                 format, content)
+                    continue
+                resized = img
             else:
-                img.thumbnail((size['width'], size['height']), Image.ANTIALIAS)
+                target = get_size(img_size, variation)
+                source = img
+                for candidate in sources:
+                    candidate_size = engine.get_size(candidate)
+                    if (candidate_size[0] >= target[0] and
+                            candidate_size[1] >= target[1]):
+                        source = candidate
+                resized = engine.resize(source, target, variation['force'])
+                timer.lap('resize', variation=variation['name'],
+                          format=variation_format,
+                          input_size=engine.get_size(source), output_size=target)
+                if not variation['force']:
+                    sources.append(resized)
+            variation_content = engine.save(resized, variation_format,
+                                            **self._get_save_options(variation))
+            timer.lap('encode', variation=variation['name'],
+                      format=variation_format, bytes=len(variation_content))
+            self._write(variation_filename, variation_content)
+            timer.lap('write', variation=variation['name'],
+                      format=variation_format, bytes=len(variation_content))
+            set_metadata(variation_filename, self.storage, engine.get_size(resized),
+                         variation_format, variation_content)
+            webp_filename = self._get_webp_filename(variation, filename)
+            if webp_filename:
+                timer.reset()
+                webp_content = engine.save(resized, 'WEBP',
+                                           **self._get_save_options(variation, True))
+                timer.lap('encode', variation=variation['name'], format='WEBP',
+                          bytes=len(webp_content))
+                self._write(webp_filename, webp_content)
+                timer.lap('write', variation=variation['name'], format='WEBP',
+                          bytes=len(webp_content))
+                set_metadata(webp_filename, self.storage,
+                             engine.get_size(resized), 'WEBP', webp_content)
+
+        fingerprints['source'] = source_fingerprint
+        variation_fingerprints = fingerprints.setdefault('variations', {})
+        for variation in variations:
+            variation_fingerprints[variation['name']] = self._get_fingerprint(
+                source_fingerprint, variation)
+        self._write(self._get_fingerprints_filename(filename), json.dumps(fingerprints))
+        return variations
+
+    def _delete_variations(self, filename):
+        """Deletes the variations of the image `filename` and their
+        fingerprints
+
+        """
+        for variation_filename in self._get_variation_filenames(filename):
+            delete_metadata(variation_filename, self.storage)
+            self._delete(variation_filename)
+        self._delete(self._get_fingerprints_filename(filename))
+
+    def _is_referenced(self, filename, exclude=None):
+        """Returns True if an object other than `exclude` stores the image
+        `filename` in a content addressed StdImageField of the same storage
+
+        """
+        for model in get_models():
+            for field in get_image_fields(model):
+                if field.content_addressed and field.storage is self.storage:
+                    queryset = model._default_manager.filter(**{field.attname: filename})
+                    if exclude is not None and isinstance(exclude, model):
+                        queryset = queryset.exclude(pk=exclude._get_pk_val())
+                    if queryset.exists():
+                        return True
+        return False
+
+    def _delete_image(self, filename, instance=None):
+        """Deletes the image `filename`, its variations and their
+        fingerprints, holding its lock. Content addressed images are kept
+        while objects other than `instance` use them.
+
+        """
+        lock = get_lock(filename)
+        lock.acquire()
+        try:
+            if self.content_addressed and self._is_referenced(filename, instance):
+                return
+            self._delete(filename)
+            self._delete_variations(filename)
+        finally:
+            lock.release()
+
+    def _has_new_image(self, instance):
+        """Returns True if the image of `instance` was uploaded since it was
+        loaded, and is not renamed yet
+
+        """
+        value = instance.__dict__.get(self.name)
+        return isinstance(value, File) and (
+            not getattr(value, '_committed', False) or
+            value.__dict__.get('_uploaded', False))
+
+    def _get_final_filename(self, instance, filename, content=None):
+        """Returns the name the image `filename` of `instance` is renamed
+        to, after the field and the primary key of the instance, or after
+        the hash of its `content` (read from the storage if not given) and
+        the variations of the field if content_addressed is True
+
+        """
+        ext = os.path.splitext(filename)[1].lower().replace('jpg', 'jpeg')
+        if not self.content_addressed:
+            return self.generate_filename(instance, '%s_%s%s' % (
+                self.name, instance._get_pk_val(), ext))
+        if CONTENT_NAME_RE.search(filename):
+            return filename
+        if content is None:
+            content = self._read(filename)
+        digest = hashlib.sha1(content)
+        digest.update(repr(sorted([sorted(v.items()) for v in self.variations])))
+        digest = digest.hexdigest()
+        # Identical images get the same name whatever the date or the object
+        return os.path.join(self._get_upload_directory(), digest[:2], digest + ext)
+
+    def _read(self, filename):
+        """Returns the content of the file `filename` of the storage"""
+        f = self.storage.open(filename)
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def _place(self, filename, dst, content=None):
+        """Moves the new image `filename` to its final name `dst`. Returns
+        False if a content addressed image `dst` exists already: it is the
+        same image, the new one is deleted instead.
+
+        """
+        if self.content_addressed and self.storage.exists(dst):
+            self._delete(filename)
+            return False
+        self._move(filename, dst, content)
+        return True
+
+    def _update_filenames(self, filenames, using=None, chunk_size=300):
+        """Stores the given (pk, filename) pairs in the database `using`
+        (the database for writes of the model by default), with one UPDATE
+        query per `chunk_size` rows
+
+        """
+        if using is None:
+            using = router.db_for_write(self.model)
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        table, column = qn(self.model._meta.db_table), qn(self.column)
+        pk_column = qn(self.model._meta.pk.column)
+        cursor = connection.cursor()
+        for i in range(0, len(filenames), chunk_size):
+            chunk = filenames[i:i + chunk_size]
+            params = []
+            for pk, filename in chunk:
+                params.extend((pk, filename))
+            params.extend([pk for pk, filename in chunk])
+            cursor.execute('UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)' % (
+                table, column, pk_column, ' '.join(['WHEN %s THEN %s'] * len(chunk)),
+                pk_column, ', '.join(['%s'] * len(chunk))), params)
+        transaction.commit_unless_managed(using=using)
+
+    def bulk_process(self, instances, processes=None):
+        """Renames the new images of the given saved instances and renders
+        their variations, like saving them one by one does. Meant for
+        instances saved without post_save signal, or with it disconnected
+        for speed during imports.
+
+        Images are renamed first and their new names stored with one query
+        per few hundred rows, then variations are rendered on a pool of
+        `processes` worker processes (the number of CPUs by default, 1
+        renders them in this process), or by the executor of the field if
+        render_async is True. Returns the number of renamed images.
+
+        """
+        filenames = {}
+        for instance in instances:
+            if instance._get_pk_val() is None:
+                raise ValueError('%r has no primary key, save it first.' % instance)
+            if not getattr(instance, self.name):
+                continue
+            filename = getattr(instance, self.name).name
+            dst = self._get_final_filename(instance, filename)
+            if filename == dst:
+                continue
+            lock = get_lock(dst)
+            lock.acquire()
             try:
-                img.save(filename, optimize=1)
-            except IOError:
-                img.save(filename)
+                if self._place(filename, dst) and self.render_on_demand:
+                    self._delete_variations(dst)
+                    self._render_variations(dst, [])
+            finally:
+                lock.release()
+            setattr(instance, self.attname, dst)
+            using = instance._state.db or router.db_for_write(self.model, instance=instance)
+            filenames.setdefault(using, []).append((instance._get_pk_val(), dst))
+        if not filenames:
+            return 0
+        for using in filenames:
+            self._update_filenames(filenames[using], using)
+        filenames = sum(filenames.values(), [])
 
-    def _rename_resize_image(self, instance=None, **kwargs):
-        """Renames the image, and calls methods to resize and create the
-        thumbnail.
+        if self.render_on_demand:
+            return len(filenames)
+        jobs = [(self.model._meta.app_label, self.model._meta.object_name,
+                 self.name, name) for name in sorted(set([f[1] for f in filenames]))]
+        if self.render_async:
+            executor = get_executor(self.executor)
+            for job in jobs:
+                executor.submit(render_variations, *job)
+        elif processes == 1:
+            for job in jobs:
+                render_variations(*job)
+        else:
+            pool = multiprocessing.Pool(processes)
+            try:
+                for result in [pool.apply_async(render_variations, job) for job in jobs]:
+                    result.get()
+            finally:
+                pool.close()
+                pool.join()
+        return len(filenames)
+
+    def _get_new_image(self, instance):
+        """Returns the current and final names of the new image of `instance`
+        and the content of its upload if it was held in memory, or None if
+        the image does not need renaming
 
         """
+        fieldfile = getattr(instance, self.name)
+        if not fieldfile:
+            return None
+        fieldfile.__dict__.pop('_uploaded', None)
+        filename = fieldfile.name
+        content = fieldfile._read_upload()
+        if self.content_addressed and content is None and \
+                not CONTENT_NAME_RE.search(filename):
+            content = self._read(filename)
+        dst = self._get_final_filename(instance, filename, content)
+        if filename == dst:
+            return None
+        return filename, dst, content
 
-        if getattr(instance, self.name):
-            filename = getattr(instance, self.name).path
-            ext = os.path.splitext(filename)[1].lower().replace('jpg', 'jpeg')
-            dst = self.generate_filename(instance, '%s_%s%s' % (self.name,
-                                                                instance._get_pk_val(), ext))
-            dst_fullpath = os.path.join(settings.MEDIA_ROOT, dst)
-            if os.path.abspath(filename) != os.path.abspath(dst_fullpath):
-                os.rename(filename, dst_fullpath)
-                if self.size:
-                    self._resize_image(dst_fullpath, self.size)
-                for variation in self.variations:
-                    variation_filename = self._get_variation_filename(variation, dst_fullpath)
-                    shutil.copyfile(dst_fullpath, variation_filename)
-                    self._resize_image(variation_filename, variation)
-                setattr(instance, self.attname, dst)
-                instance.save()
+    def _render_new_image(self, filename, content=None, placed=True):
+        """Renders the variations of the image just renamed to `filename`,
+        unless they are rendered asynchronously or on demand. If the image
+        was not `placed` (its content addressed name existed already), only
+        its out of date variations are rendered.
+
+        """
+        if not placed and (self.render_on_demand or
+                           not self._get_stale_variations(filename)):
+            return
+        if self.render_on_demand:
+            self._delete_variations(filename)
+            self._render_variations(filename, [], content=content)
+        elif not self.render_async:
+            self._render_variations(filename, content=content)
 
     def _set_thumbnail(self, instance=None, **kwargs):
         """Creates a "thumbnail" object as attribute of the ImageField instance
@@ -215,11 +997,10 @@ class StdImageField(ImageField):
         """
         warn('This setter is deprecated in favor of _set_variations.', DeprecationWarning)
         if getattr(instance, self.name):
-            filename = self.generate_filename(instance,
-                                              os.path.basename(getattr(instance, self.name).path))
+            filename = getattr(instance, self.name).name
             variation = getattr(self, 'thumbnail')
             thumbnail_filename = self._get_variation_filename(variation, filename)
-            thumbnail_field = VariationField(thumbnail_filename)
+            thumbnail_field = VariationField(thumbnail_filename, self.storage)
             setattr(getattr(instance, self.name), 'thumbnail', thumbnail_field)
 
     def set_variations(self, instance=None, **kwargs):
@@ -227,20 +1008,84 @@ class StdImageField(ImageField):
         Variation attribute will be of the same class as the original image, so
         "path", "url"... properties can be used
         """
+        warn('Variations are created on first access, set_variations is deprecated.', DeprecationWarning)
         if getattr(instance, self.name):
-            filename = self.generate_filename(instance,
-                                              os.path.basename(getattr(instance, self.name).path))
+            filename = getattr(instance, self.name).name
             for variation in self.variations:
                 if variation['name'] != 'size':
                     variation_filename = self._get_variation_filename(variation, filename)
-                    variation_field = VariationField(variation_filename)
+                    variation_field = VariationField(variation_filename, self.storage)
                     setattr(getattr(instance, self.name), variation['name'], variation_field)
 
+    def _get_url_prefix(self):
+        """Returns the prefix of the urls of the storage, if urls are built
+        by appending file names to it, None otherwise
+
+        """
+        try:
+            prefix = self.storage.url('')
+            if self.storage.url('stdimage/url.jpeg') == prefix + 'stdimage/url.jpeg':
+                return prefix
+        except (NotImplementedError, ValueError):
+            pass
+        return None
+
+    def get_variation_urls(self, instances):
+        """Returns, for each instance, a dictionary with the url of its image
+        as 'url' and the urls of its variations by variation name, and of
+        their WebP copies by variation name followed by '_webp' (an empty
+        dictionary if the instance has no image).
+
+        Urls are built from prefixes computed once for all the instances,
+        without creating field files or variation objects.
+
+        """
+        prefix = self._get_url_prefix()
+        placeholder = 'stdimage-name'
+        # (key, variation, format) of the urls of each image
+        variations = []
+        for variation in self.variations:
+            if variation['name'] != 'size':
+                variations.append((variation['name'], variation,
+                                   variation.get('format')))
+                if self._get_webp_filename(variation, placeholder):
+                    variations.append(('%s_webp' % variation['name'],
+                                       variation, 'WEBP'))
+        templates = {}
+        if self.render_on_demand:
+            for key, variation, format in variations:
+                templates[key] = self._get_variation_url(variation, placeholder)
+                if key != variation['name']:
+                    templates[key] += '?format=webp'
+        if prefix is None:
+            url = self.storage.url
+        else:
+            url = lambda name: prefix + filepath_to_uri(name)
+        result = []
+        for instance in instances:
+            name = instance.__dict__.get(self.name)
+            name = getattr(name, 'name', name)
+            urls = {}
+            if name:
+                urls['url'] = url(name)
+                root, ext = os.path.splitext(name)
+                for key, variation, format in variations:
+                    if key in templates:
+                        urls[key] = templates[key].replace(
+                            placeholder, filepath_to_uri(name))
+                    else:
+                        urls[key] = url('%s.%s%s' % (root, variation['name'],
+                                                     format and EXTENSIONS[format] or ext))
+            result.append(urls)
+        return result
+
     def formfield(self, **kwargs):
         """Specify form field and widget to be used on the forms"""
 
         kwargs['widget'] = DelAdminFileWidget
         kwargs['form_class'] = StdImageFormField
+        kwargs['max_pixels'] = self.max_pixels
+        kwargs['max_bytes'] = self.max_bytes
         return super(StdImageField, self).formfield(**kwargs)
 
     def save_form_data(self, instance, data):
@@ -249,14 +1094,10 @@ class StdImageField(ImageField):
 
         """
         if data == '__deleted__':
-            filename = getattr(instance, self.name).path
-            if os.path.exists(filename):
-                os.remove(filename)
-            for variation in self.variations:
-                variation_filename = self._get_variation_filename(variation, filename)
-                if os.path.exists(variation_filename):
-                    os.remove(variation_filename)
-                    setattr(instance, self.name, None)
+            filename = getattr(instance, self.name).name
+            if filename:
+                self._delete_image(filename, instance)
+            setattr(instance, self.name, None)
         else:
             super(StdImageField, self).save_form_data(instance, data)
 
@@ -275,5 +1116,110 @@ class StdImageField(ImageField):
         """Call methods for generating all operations on specified signals"""
 
         super(StdImageField, self).contribute_to_class(cls, name)
-        signals.post_save.connect(self._rename_resize_image, sender=cls)
-        signals.post_init.connect(self.set_variations, sender=cls)
+        # The receivers handle all the StdImageFields of the model at once
+        signals.pre_save.connect(remember_old_images, sender=cls,
+                                 dispatch_uid='stdimage.remember_old_images')
+        signals.post_save.connect(process_images, sender=cls,
+                                  dispatch_uid='stdimage.process_images')
+        signals.post_delete.connect(delete_images, sender=cls,
+                                    dispatch_uid='stdimage.delete_images')
+
+
+def get_image_fields(model):
+    """Returns the StdImageFields of `model`"""
+    return [f for f in model._meta.fields if isinstance(f, StdImageField)]
+
+
+def remember_old_images(sender, instance=None, **kwargs):
+    """Remembers the names of the images replaced by new uploads, read from
+    the database with one query before the instance is saved, so their files
+    are deleted once the uploads are renamed
+
+    """
+    pk = instance._get_pk_val()
+    if pk is None:
+        return
+    fields = [f for f in get_image_fields(sender) if f._has_new_image(instance)]
+    if not fields:
+        return
+    using = kwargs.get('using') or instance._state.db or \
+        router.db_for_write(sender, instance=instance)
+    rows = list(sender._default_manager.using(using).filter(pk=pk).values_list(
+        *[f.attname for f in fields]))
+    if rows:
+        old_names = instance.__dict__.setdefault('_stdimage_old_names', {})
+        for field, name in zip(fields, rows[0]):
+            if name:
+                old_names[field.name] = name
+
+
+def process_images(sender, instance=None, **kwargs):
+    """Renames the new images of all the StdImageFields of the saved
+    instance and renders their variations, concurrently when there are
+    several, then stores their new names with one query.
+
+    Renames and renders hold a lock on the new names (see stdimage.locks),
+    so concurrent saves of the same object run one after the other and the
+    last one wins; variations rendered again from the same image are skipped
+    thanks to their fingerprints.
+
+    """
+    old_names = instance.__dict__.pop('_stdimage_old_names', {})
+    images = []
+    for field in get_image_fields(sender):
+        image = field._get_new_image(instance)
+        if image is not None:
+            images.append((field,) + image)
+    if images:
+        locks = [get_lock(dst) for dst in sorted(set([i[2] for i in images]))]
+        for lock in locks:
+            lock.acquire()
+        try:
+            timers = []
+            placed = []
+            for field, filename, dst, content in images:
+                timer = get_timer(field, dst)
+                placed.append(field._place(filename, dst, content))
+                timer.lap('rename')
+                timers.append(timer)
+            try:
+                run_in_threads([(field._render_new_image, (dst, content, placed[i]))
+                                for i, (field, filename, dst, content) in enumerate(images)])
+            except Exception:
+                # The images keep their names in the database, an image that
+                # can not be decoded leaves no file behind under its new name
+                exc_info = sys.exc_info()
+                for i, (field, filename, dst, content) in enumerate(images):
+                    if placed[i]:
+                        field._delete_variations(dst)
+                        field._move(dst, filename, content)
+                raise exc_info[0], exc_info[1], exc_info[2]
+            for timer in timers:
+                timer.reset()
+            for field, filename, dst, content in images:
+                setattr(instance, field.attname, dst)
+            using = kwargs.get('using') or instance._state.db
+            sender._default_manager.using(using).filter(pk=instance._get_pk_val()).update(
+                **dict([(field.attname, dst) for field, filename, dst, content in images]))
+            for timer in timers:
+                timer.lap('save')
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+    for field, filename, dst, content in images:
+        old_filename = old_names.get(field.name)
+        if old_filename and old_filename != dst:
+            field._delete_image(old_filename, instance)
+        if field.render_async:
+            get_executor(field.executor).submit(
+                render_variations, instance._meta.app_label,
+                instance._meta.object_name, field.name, dst)
+
+
+def delete_images(sender, instance=None, **kwargs):
+    """Deletes the files of the images of a deleted instance"""
+    for field in get_image_fields(sender):
+        value = instance.__dict__.get(field.name)
+        filename = getattr(value, 'name', value)
+        if filename:
+            field._delete_image(filename, instance)
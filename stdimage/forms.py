@@ -1,9 +1,71 @@
 # -*- coding: utf-8 -*-
-from django.forms.fields import ImageField
+from django.conf import settings
+from django.forms.fields import FileField, ImageField
+from django.forms.util import ValidationError
+from django.utils.translation import ugettext_lazy as _
 
 class StdImageFormField(ImageField):
+    """ImageField rejecting the images over a budget of pixels or bytes,
+    `max_pixels` and `max_bytes` (the STDIMAGE_MAX_PIXELS and
+    STDIMAGE_MAX_BYTES settings by default)
+
+    """
+    default_error_messages = {
+        'too_many_pixels': _(u'Ensure this image has at most %(max)s pixels (it has %(pixels)s).'),
+        'too_many_bytes': _(u'Ensure this image has at most %(max)s bytes (it has %(bytes)s).'),
+    }
+
+    def __init__(self, *args, **kwargs):
+        self.max_pixels = kwargs.pop('max_pixels', None)
+        self.max_bytes = kwargs.pop('max_bytes', None)
+        super(StdImageFormField, self).__init__(*args, **kwargs)
+
     def clean(self, data, initial=None):
         if data != '__deleted__':
             return super(StdImageFormField, self).clean(data, initial)
         else:
             return '__deleted__'
+
+    def to_python(self, data):
+        """Checks that the upload is an image reading its header and checking
+        its structure, from the temporary file or the uploaded file itself,
+        instead of decoding the whole image like ImageField. The size and format
+        of the image are kept as `image_size` and `image_format` on the
+        upload.
+
+        """
+        f = FileField.to_python(self, data)
+        if f is None:
+            return None
+
+        max_bytes = self.max_bytes or getattr(settings, 'STDIMAGE_MAX_BYTES', None)
+        if max_bytes and data.size > max_bytes:
+            raise ValidationError(self.error_messages['too_many_bytes'] % {
+                'max': max_bytes, 'bytes': data.size})
+
+        try:
+            import Image
+        except ImportError:
+            from PIL import Image
+        if hasattr(data, 'temporary_file_path'):
+            file = data.temporary_file_path()
+        else:
+            file = data
+            file.seek(0)
+        try:
+            img = Image.open(file)
+        except Exception:
+            raise ValidationError(self.error_messages['invalid_image'])
+        max_pixels = self.max_pixels or getattr(settings, 'STDIMAGE_MAX_PIXELS', None)
+        if max_pixels and img.size[0] * img.size[1] > max_pixels:
+            raise ValidationError(self.error_messages['too_many_pixels'] % {
+                'max': max_pixels, 'pixels': img.size[0] * img.size[1]})
+        try:
+            img.verify()
+        except Exception:
+            raise ValidationError(self.error_messages['invalid_image'])
+        f.image_size = img.size
+        f.image_format = img.format
+        if hasattr(f, 'seek') and callable(f.seek):
+            f.seek(0)
+        return f
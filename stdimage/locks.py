@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""Locks serializing the renames and renders of an image.
+
+A lock is built from a key, the name of the image, and has acquire and
+release methods; it can be used as a context manager. The class of the
+locks is set by the STDIMAGE_LOCK setting, FileLock being the default.
+
+"""
+import binascii
+import errno
+import fcntl
+import hashlib
+import os
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from utils import import_object
+
+
+class FileLock(object):
+    """Exclusive lock on `key`, shared by the threads and processes of a host
+    through a lock file in the STDIMAGE_LOCK_DIR directory (the temporary
+    directory by default), removed when the lock is released
+
+    """
+
+    def __init__(self, key):
+        directory = getattr(settings, 'STDIMAGE_LOCK_DIR', None) or tempfile.gettempdir()
+        key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        self.path = os.path.join(directory, 'stdimage-%s.lock' % key)
+        self.file = None
+
+    def acquire(self):
+        while True:
+            file = open(self.path, 'a')
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+            # The holder that was waited for may have removed the file, the
+            # lock is only held if the file is still there
+            try:
+                if os.stat(self.path).st_ino == os.fstat(file.fileno()).st_ino:
+                    break
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    file.close()
+                    raise
+            file.close()
+        self.file = file
+
+    def release(self):
+        # The file is removed while locked, so there is one lock file per
+        # image being processed only
+        os.remove(self.path)
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.file.close()
+        self.file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class CacheLock(object):
+    """Exclusive lock on `key` kept in the Django cache, shared by all the
+    hosts using the same cache. It expires after STDIMAGE_LOCK_TIMEOUT
+    seconds (5 minutes by default) so a crashed holder does not block the
+    image forever.
+
+    """
+
+    def __init__(self, key):
+        self.key = 'stdimage-lock:%s' % hashlib.sha1(key.encode('utf-8')).hexdigest()
+        self.timeout = getattr(settings, 'STDIMAGE_LOCK_TIMEOUT', 300)
+        self.token = None
+
+    def acquire(self):
+        token = binascii.hexlify(os.urandom(8))
+        delay = 0.01
+        while not cache.add(self.key, token, self.timeout):
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
+        self.token = token
+
+    def release(self):
+        if cache.get(self.key) == self.token:
+            cache.delete(self.key)
+        self.token = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def get_lock(key):
+    """Returns a lock on `key` of the class set by the STDIMAGE_LOCK setting
+    (a class or its dotted path), FileLock by default
+
+    """
+    lock_class = getattr(settings, 'STDIMAGE_LOCK', 'stdimage.locks.FileLock')
+    return import_object(lock_class)(key)
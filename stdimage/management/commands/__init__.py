@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import CommandError
+from django.db.models import get_model
+
+from stdimage.fields import StdImageField
+
+
+def get_fields(spec):
+    """Returns the (model, field) pairs of the StdImageFields named by
+    `spec`, app_label.Model for all the fields of the model or
+    app_label.Model.field for one of them
+
+    """
+    parts = spec.split('.')
+    if len(parts) not in (2, 3):
+        raise CommandError('Invalid field %r, use app_label.Model[.field].' % spec)
+    app_label, model_name, field_name = (parts + [None])[:3]
+    model = get_model(app_label, model_name)
+    if model is None:
+        raise CommandError('Unknown model %s.%s.' % (app_label, model_name))
+    fields = [(model, f) for f in model._meta.fields
+              if isinstance(f, StdImageField) and
+              (field_name is None or f.name == field_name)]
+    if not fields:
+        raise CommandError('%s has no StdImageField.' % spec)
+    return fields
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import sys
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db.models import AutoField, IntegerField, get_models
+
+from stdimage.fields import CONTENT_NAME_RE, StdImageField
+from stdimage.locks import get_lock
+from stdimage.management.commands import get_fields
+from stdimage.metadata import delete_metadata, get_modified_time
+
+
+class Command(BaseCommand):
+    args = '[app_label.Model[.field] ...]'
+    help = ('Deletes the images, variations and fingerprints left in the upload '
+            'directories of the given StdImageFields (all of them by default), '
+            'and in their hash subdirectories for content addressed fields, '
+            'that no object references anymore.')
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False,
+                    help='List the orphaned files without deleting them.'),
+        make_option('--min-age', type='int', dest='min_age', default=3600,
+                    help='Only delete files older than this number of seconds, '
+                         'so images being saved are left alone.'),
+    )
+
+    def handle(self, *specs, **options):
+        self.verbosity = int(options.get('verbosity', 1))
+        self.dry_run = options.get('dry_run')
+        self.min_age = options.get('min_age')
+        if self.min_age is None:
+            self.min_age = 3600
+
+        # Fields storing their images in the same directory share it, the
+        # names referenced by all of them are kept
+        directories = {}
+        for model in get_models():
+            for field in model._meta.fields:
+                if not isinstance(field, StdImageField):
+                    continue
+                directory = self.get_directory(field)
+                if directory is not None:
+                    key = (id(field.storage), directory)
+                    directories.setdefault(key, []).append((model, field))
+
+        selected = None
+        if specs:
+            selected = set()
+            for spec in specs:
+                selected.update(get_fields(spec))
+        for (storage_id, directory), fields in sorted(directories.items()):
+            if selected is None or selected.intersection(fields):
+                self.collect(directory, fields)
+
+    def get_directory(self, field):
+        """Returns the upload directory of the field, None if it depends on
+        the object or the date. Content addressed images are always in the
+        fixed part of the upload directory.
+
+        """
+        if field.content_addressed:
+            return field._get_upload_directory()
+        if not self.is_fixed(field):
+            if self.verbosity > 0:
+                sys.stdout.write('%s.%s.%s: skipped, its upload directory is not '
+                                 'fixed\n' % (field.model._meta.app_label,
+                                              field.model._meta.object_name,
+                                              field.name))
+            return None
+        return os.path.normpath(field.upload_to)
+
+    def is_fixed(self, field):
+        """Returns True if the upload directory of the field does not depend
+        on the object or the date
+
+        """
+        return not callable(field.upload_to) and '%' not in field.upload_to
+
+    def get_pk_re(self, model):
+        """Returns a regular expression matching the primary keys of
+        `model` in the names of its images
+
+        """
+        if isinstance(model._meta.pk, (AutoField, IntegerField)):
+            return r'-?\d+'
+        return r'[^/]+?'
+
+    def get_names_re(self, fields, base):
+        """Returns a regular expression matching the names the given fields
+        give to the images whose name without extension matches `base`, to
+        their variations and to their fingerprints, and no other name
+
+        """
+        patterns = []
+        for field in fields:
+            variations = [re.escape(variation['name'])
+                          for variation in field.variations
+                          if variation['name'] != 'size']
+            pattern = r'\.[^./]+\.stdimage|\.[^./]+'
+            if variations:
+                pattern += r'|\.(?:%s)\.[^./]+' % '|'.join(variations)
+            patterns.append(pattern)
+        return re.compile(r'^%s(?:%s)$' % (base, '|'.join(patterns)))
+
+    def get_group(self, name):
+        """Returns the name of `name` without its extensions, shared by an
+        image, its variations and their fingerprints
+
+        """
+        return os.path.join(os.path.dirname(name),
+                            os.path.basename(name).split('.')[0])
+
+    def collect(self, directory, fields):
+        storage = fields[0][1].storage
+        if not storage.exists(directory):
+            return
+        # The directory is listed before reading the database, files created
+        # in between can not be taken for orphans
+        names_res = [self.get_names_re([field], '%s_%s' % (
+            re.escape(field.name), self.get_pk_re(model)))
+            for model, field in fields if self.is_fixed(field)]
+        dirs, files = storage.listdir(directory)
+        candidates = [os.path.join(directory, name) for name in files
+                      if [names_re for names_re in names_res if names_re.match(name)]]
+        content_addressed = [field for model, field in fields
+                             if field.content_addressed]
+        if content_addressed:
+            # Content addressed images are in subdirectories named after the
+            # first digits of their hash, other files there are left alone
+            for subdirectory in dirs:
+                if re.match(r'^[0-9a-f]{2}$', subdirectory):
+                    names_re = self.get_names_re(
+                        content_addressed, re.escape(subdirectory) + '[0-9a-f]{38}')
+                    subdirectory = os.path.join(directory, subdirectory)
+                    candidates.extend([os.path.join(subdirectory, name)
+                                       for name in storage.listdir(subdirectory)[1]
+                                       if names_re.match(name)])
+
+        referenced = set()
+        for model, field in fields:
+            names = model._default_manager.exclude(**{field.attname: ''}).values_list(
+                field.attname, flat=True)
+            for name in names.iterator():
+                referenced.add(name)
+                referenced.update(field._get_variation_filenames(name))
+                referenced.add(field._get_fingerprints_filename(name))
+
+        limit = time.time() - self.min_age
+        orphans = [name for name in candidates if name not in referenced and
+                   get_modified_time(name, storage) < limit]
+
+        # Orphans are deleted by image, holding its lock like saves do: a
+        # content addressed image may be used again by an object saved since
+        # the database was read
+        images = dict([(self.get_group(name), name) for name in candidates
+                       if os.path.basename(name).count('.') == 1])
+        groups = {}
+        for name in orphans:
+            group = self.get_group(name)
+            groups.setdefault(images.get(group, group), []).append(name)
+        for image, names in sorted(groups.items()):
+            lock = get_lock(image)
+            lock.acquire()
+            try:
+                if content_addressed and CONTENT_NAME_RE.search(image) and \
+                        content_addressed[0]._is_referenced(image):
+                    orphans = [name for name in orphans if name not in names]
+                    continue
+                for name in names:
+                    if self.verbosity > 1:
+                        sys.stdout.write('%s\n' % name)
+                    if not self.dry_run:
+                        delete_metadata(name, storage)
+                        fields[0][1]._delete(name)
+            finally:
+                lock.release()
+        if self.verbosity > 0:
+            sys.stdout.write('%s: %d orphaned files %s\n' % (
+                directory, len(orphans),
+                self.dry_run and 'found' or 'deleted'))
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import logging
+import multiprocessing
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+
+from stdimage.engines import get_engine
+from stdimage.fields import ImageTooLarge
+from stdimage.locks import get_lock
+from stdimage.management.commands import get_fields
+
+logger = logging.getLogger('stdimage')
+
+
+def render(job):
+    """Renders the out of date variations of one image, returns the number
+    of rendered variations
+
+    """
+    app_label, model_name, field_name, name, force = job
+    field = get_model(app_label, model_name)._meta.get_field(field_name)
+    errors = get_engine(field.engine).errors
+    lock = get_lock(name)
+    lock.acquire()
+    try:
+        if force:
+            variations = field.variations
+        else:
+            variations = field._get_stale_variations(name)
+        if not variations:
+            return 0
+        return len(field._render_variations(name, variations, force))
+    except ImageTooLarge, e:
+        logger.warning('%s skipped: %s', name, e)
+        return 0
+    except errors, e:
+        # One missing or broken image does not stop the rendering of the
+        # others
+        logger.error('%s skipped: %s', name, e)
+        return 0
+    finally:
+        lock.release()
+
+
+class Command(BaseCommand):
+    args = '<app_label.Model[.field] ...>'
+    help = ('(Re)generates the variations of the images stored by the given '
+            'StdImageFields, skipping the ones rendered from the same image '
+            'with the same options. Temporary files left by interrupted '
+            'renders are removed.')
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', '-p', type='int', dest='processes',
+                    default=None,
+                    help='Number of worker processes (defaults to the number of CPUs).'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=500,
+                    help='Number of images fetched from the database at a time.'),
+        make_option('--start', dest='start', default=None,
+                    help='Only process the objects with a primary key greater than this one, '
+                         'to resume an interrupted run.'),
+        make_option('--force', action='store_true', dest='force', default=False,
+                    help='Render all the variations, even the up to date ones.'),
+    )
+
+    def handle(self, *specs, **options):
+        if not specs:
+            raise CommandError('Enter at least one app_label.Model[.field].')
+        fields = []
+        for spec in specs:
+            fields.extend(get_fields(spec))
+
+        self.verbosity = int(options.get('verbosity', 1))
+        self.chunk_size = options.get('chunk_size') or 500
+        self.start = options.get('start')
+        self.force = options.get('force')
+        processes = options.get('processes')
+        self.pool = None
+        if processes != 1:
+            self.pool = multiprocessing.Pool(processes)
+        try:
+            for model, field in fields:
+                self.render_field(model, field)
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+
+    def render_field(self, model, field):
+        removed = field._clean_temp_files()
+        if removed and self.verbosity > 0:
+            sys.stdout.write('%s.%s.%s: %d temporary files removed\n' % (
+                model._meta.app_label, model._meta.object_name, field.name,
+                removed))
+        queryset = model._default_manager.exclude(**{field.attname: ''})
+        if self.start is not None:
+            queryset = queryset.filter(pk__gt=self.start)
+        queryset = queryset.order_by('pk').values_list('pk', field.attname)
+        total = queryset.count()
+        done = rendered = 0
+        chunk = []
+        for row in queryset.iterator():
+            chunk.append(row)
+            if len(chunk) == self.chunk_size:
+                rendered += self.render_chunk(model, field, chunk)
+                done += len(chunk)
+                self.report(model, field, done, total, rendered, chunk[-1][0])
+                chunk = []
+        if chunk:
+            rendered += self.render_chunk(model, field, chunk)
+            done += len(chunk)
+            self.report(model, field, done, total, rendered, chunk[-1][0])
+
+    def render_chunk(self, model, field, chunk):
+        jobs = [(model._meta.app_label, model._meta.object_name, field.name,
+                 name, self.force) for pk, name in chunk if name]
+        if self.pool is None:
+            return sum(map(render, jobs))
+        return sum(self.pool.map(render, jobs))
+
+    def report(self, model, field, done, total, rendered, last_pk):
+        if self.verbosity > 0:
+            sys.stdout.write('%s.%s.%s: %d/%d images, %d variations rendered '
+                             '(resume with --start=%s)\n' % (
+                                 model._meta.app_label, model._meta.object_name,
+                                 field.name, done, total, rendered, last_pk))
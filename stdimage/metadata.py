@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""Cache of the metadata of the variations: byte size, width, height, format
+and modification time. It is filled when variations are rendered, so they
+can be used in templates without touching the storage.
+
+"""
+import hashlib
+import os
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.images import get_image_dimensions
+
+from engines import FORMATS
+
+
+def get_key(name, storage):
+    """Returns the cache key of the file `name` of `storage`, storages being
+    told apart by their location
+
+    """
+    location = getattr(storage, 'location', None) or '%s.%s' % (
+        storage.__class__.__module__, storage.__class__.__name__)
+    return 'stdimage:%s' % hashlib.md5(
+        ('%s:%s' % (location, name)).encode('utf-8')).hexdigest()
+
+
+def set_metadata(name, storage, img_size, format, content):
+    """Records the metadata of the file `name` of `storage`, just written
+    with `content`
+
+    """
+    cache.set(get_key(name, storage), {
+        'size': len(content),
+        'width': img_size[0],
+        'height': img_size[1],
+        'format': format,
+        'modified': time.time(),
+    }, getattr(settings, 'STDIMAGE_CACHE_TIMEOUT', None))
+
+
+def delete_metadata(name, storage):
+    cache.delete(get_key(name, storage))
+
+
+def get_modified_time(name, storage):
+    """Returns the modification time of the file `name` of `storage`, as a
+    timestamp
+
+    """
+    try:
+        return os.path.getmtime(storage.path(name))
+    except NotImplementedError:
+        return time.mktime(storage.modified_time(name).timetuple())
+
+
+def read_metadata(name, storage):
+    """Returns the metadata of the file `name` of `storage`, reading them
+    from the storage, or None if the file does not exist
+
+    """
+    if not storage.exists(name):
+        return None
+    f = storage.open(name)
+    try:
+        width, height = get_image_dimensions(f)
+    finally:
+        f.close()
+    return {
+        'size': storage.size(name),
+        'width': width,
+        'height': height,
+        'format': FORMATS.get(os.path.splitext(name)[1].lower()),
+        'modified': get_modified_time(name, storage),
+    }
+
+
+def get_metadata(name, storage, read=True):
+    """Returns the metadata of the file `name` of `storage`, from the cache
+    if possible. Returns None if the file does not exist, or if they are not
+    cached and `read` is False.
+
+    """
+    metadata = cache.get(get_key(name, storage))
+    if metadata is None and read:
+        metadata = read_metadata(name, storage)
+        if metadata is not None:
+            cache.set(get_key(name, storage), metadata,
+                      getattr(settings, 'STDIMAGE_CACHE_TIMEOUT', None))
+    return metadata
+
+
+def get_many(names, storage):
+    """Returns a dictionary with the cached metadata of the given names of
+    `storage`
+
+    """
+    keys = dict([(get_key(name, storage), name) for name in names])
+    return dict([(keys[key], metadata)
+                 for key, metadata in cache.get_many(keys.keys()).items()])
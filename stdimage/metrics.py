@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""Timings of the stages of the processing of images, for monitoring.
+
+Set the STDIMAGE_METRICS_CALLBACK setting to a callable (or its dotted path)
+to receive them. It is called for each stage as::
+
+    callback(stage, duration, field='app_label.Model.field', name=image_name,
+             **info)
+
+`duration` is in seconds. Stages are 'rename', 'read', 'decode', 'resize',
+'encode', 'write' and 'save' (the update of the database). Resize, encode and
+write stages have the name of the variation as `variation` ('size' for the
+image itself) and the `format` of the output; resize stages have the
+`input_size` and `output_size`, encode and write stages the `bytes` of the
+output, decode stages the `size` of the image. Nothing is measured when the
+setting is unset.
+
+"""
+import time
+
+from django.conf import settings
+
+from utils import import_object
+
+_callbacks = {}
+
+
+class NullTimer(object):
+    """Timer of disabled metrics, doing nothing"""
+
+    def lap(self, stage, **info):
+        pass
+
+    def reset(self):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class Timer(object):
+    """Measures the stages of the processing of an image, each one lasting
+    from the end of the previous one
+
+    """
+
+    def __init__(self, callback, field, name):
+        self.callback = callback
+        self.field = field
+        self.name = name
+        self.start = time.time()
+
+    def lap(self, stage, **info):
+        """Reports the stage ending now"""
+        now = time.time()
+        self.callback(stage, now - self.start, field=self.field, name=self.name,
+                      **info)
+        self.start = time.time()
+
+    def reset(self):
+        """Starts the next stage now, the time elapsed since the previous one
+        is not reported
+
+        """
+        self.start = time.time()
+
+
+def get_callback():
+    """Returns the callable set by the STDIMAGE_METRICS_CALLBACK setting, or
+    None
+
+    """
+    callback = getattr(settings, 'STDIMAGE_METRICS_CALLBACK', None)
+    if isinstance(callback, basestring):
+        if callback not in _callbacks:
+            _callbacks[callback] = import_object(callback)
+        callback = _callbacks[callback]
+    return callback
+
+
+def get_timer(field, name):
+    """Returns a timer of the processing of the image `name` stored by
+    `field`, doing nothing if metrics are disabled
+
+    """
+    callback = get_callback()
+    if callback is None:
+        return NULL_TIMER
+    return Timer(callback, '%s.%s.%s' % (field.model._meta.app_label,
+                                         field.model._meta.object_name,
+                                         field.name), name)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+from django import template
+from django.utils.html import conditional_escape
+from django.utils.safestring import mark_safe
+
+register = template.Library()
+
+
+class VariationUrlsNode(template.Node):
+    def __init__(self, instances, field_name, var_name):
+        self.instances = instances
+        self.field_name = field_name
+        self.var_name = var_name
+
+    def render(self, context):
+        instances = list(self.instances.resolve(context))
+        urls = []
+        if instances:
+            field = instances[0]._meta.get_field(self.field_name.resolve(context))
+            urls = field.get_variation_urls(instances)
+        context[self.var_name] = zip(instances, urls)
+        return ''
+
+
+@register.tag
+def variation_urls(parser, token):
+    """Resolves the urls of the image and variations of a StdImageField for
+    a list of objects in one pass. Example::
+
+        {% variation_urls object_list "image" as images %}
+        {% for object, urls in images %}
+            <a href="{{ urls.url }}"><img src="{{ urls.thumbnail }}"/></a>
+        {% endfor %}
+
+    """
+    bits = token.split_contents()
+    if len(bits) != 5 or bits[3] != 'as':
+        raise template.TemplateSyntaxError(
+            "'%s' takes the form: {%% %s objects \"field\" as var %%}" % (bits[0], bits[0]))
+    return VariationUrlsNode(parser.compile_filter(bits[1]),
+                             parser.compile_filter(bits[2]), bits[4])
+
+
+class SrcsetImgNode(template.Node):
+    def __init__(self, image, sizes=None, alt=None):
+        self.image = image
+        self.sizes = sizes
+        self.alt = alt
+
+    def render(self, context):
+        image = self.image.resolve(context)
+        if not image:
+            return ''
+        attrs = []
+        if image.field.srcset:
+            largest = getattr(image, image.field.srcset[-1]['name'])
+            attrs.append(('src', largest.url))
+            attrs.append(('srcset', image.srcset))
+            if self.sizes is not None:
+                attrs.append(('sizes', self.sizes.resolve(context)))
+            if largest.width:
+                attrs.append(('width', largest.width))
+                attrs.append(('height', largest.height))
+        else:
+            attrs.append(('src', image.url))
+        alt = ''
+        if self.alt is not None:
+            alt = self.alt.resolve(context)
+        attrs.append(('alt', alt))
+        return mark_safe('<img %s/>' % ' '.join(
+            ['%s="%s"' % (name, conditional_escape(value)) for name, value in attrs]))
+
+
+@register.tag
+def srcset_img(parser, token):
+    """Renders an img element for the image of a StdImageField, with the
+    srcset of its width ladder (see the `srcset` option of the field), the
+    `sizes` and `alt` attributes given and the width and height of the
+    largest variation. Example::
+
+        {% srcset_img object.image "(max-width: 640px) 100vw, 640px" "A photo" %}
+
+    """
+    bits = token.split_contents()
+    if len(bits) not in (2, 3, 4):
+        raise template.TemplateSyntaxError(
+            "'%s' takes the form: {%% %s image [\"sizes\"] [\"alt\"] %%}" % (bits[0], bits[0]))
+    return SrcsetImgNode(*[parser.compile_filter(bit) for bit in bits[1:]])
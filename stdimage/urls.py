@@ -0,0 +1,6 @@
+from django.conf.urls.defaults import *
+
+urlpatterns = patterns('stdimage.views',
+    url(r'^(?P<app_label>\w+)/(?P<model_name>\w+)/(?P<field_name>\w+)/(?P<variation_name>\w+)/(?P<name>.+)$',
+        'variation', name='stdimage-variation'),
+)
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import binascii
+import os
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.utils.importlib import import_module
+
+
+def import_object(value):
+    """Returns the object `value` refers to, importing it if it is a dotted
+    path
+
+    """
+    if isinstance(value, basestring):
+        module, attr = value.rsplit('.', 1)
+        value = getattr(import_module(module), attr)
+    return value
+
+
+def get_object(value):
+    """Returns the object `value` refers to: dotted paths are imported and
+    classes are instantiated without arguments
+
+    """
+    value = import_object(value)
+    if isinstance(value, type):
+        value = value()
+    return value
+
+
+# Prefix of the temporary files written by write_atomic
+TEMP_PREFIX = '.stdimage-'
+
+
+def make_directory(directory):
+    """Creates `directory` and its parents if they do not exist, even if
+    another process creates them at the same time
+
+    """
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+
+def write_atomic(path, content):
+    """Writes `content` to the file `path` through a temporary file of the
+    same directory renamed into place, so readers see either the old or the
+    new file, never a partial one
+
+    """
+    directory = os.path.dirname(path)
+    make_directory(directory)
+    tmp_path = os.path.join(directory, '%s%d-%s.tmp' % (
+        TEMP_PREFIX, os.getpid(), binascii.hexlify(os.urandom(8))))
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                 getattr(os, 'O_BINARY', 0), 0666)
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(content)
+        finally:
+            f.close()
+        if getattr(settings, 'FILE_UPLOAD_PERMISSIONS', None) is not None:
+            os.chmod(tmp_path, settings.FILE_UPLOAD_PERMISSIONS)
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+def clean_temp_files(directory, max_age=None):
+    """Removes the temporary files left under `directory` by write_atomic
+    calls that did not complete (older than `max_age` seconds, the
+    STDIMAGE_TEMP_MAX_AGE setting or an hour by default), returns their number
+
+    """
+    if max_age is None:
+        max_age = getattr(settings, 'STDIMAGE_TEMP_MAX_AGE', 3600)
+    limit = time.time() - max_age
+    removed = 0
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            if name.startswith(TEMP_PREFIX):
+                path = os.path.join(root, name)
+                try:
+                    if os.path.getmtime(path) < limit:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    pass
+    return removed
+
+
+def run_in_threads(calls):
+    """Runs the given (function, args) calls, on threads if there are
+    several, and waits for them. The first exception raised by a call is
+    raised again.
+
+    """
+    if len(calls) < 2:
+        for func, args in calls:
+            func(*args)
+        return
+    errors = []
+
+    def run(func, args):
+        try:
+            func(*args)
+        except Exception:
+            errors.append(sys.exc_info())
+    threads = [threading.Thread(target=run, args=call) for call in calls]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
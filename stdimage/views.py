@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import mimetypes
+
+from django.conf import settings
+from django.core.servers.basehttp import FileWrapper
+from django.db.models import get_model
+from django.db.models.fields import FieldDoesNotExist
+from django.http import Http404, HttpResponse
+
+from fields import ImageTooLarge, StdImageField
+from locks import get_lock
+
+
+def serve(storage, name):
+    """Returns a response with the file `name` of `storage`. With the
+    STDIMAGE_SENDFILE_HEADER setting, the file is left to the web server:
+    X-Accel-Redirect gets the URL of the file, other headers (X-Sendfile...)
+    its path.
+
+    """
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    header = getattr(settings, 'STDIMAGE_SENDFILE_HEADER', None)
+    if header:
+        response = HttpResponse(content_type=content_type)
+        if header == 'X-Accel-Redirect':
+            response[header] = storage.url(name)
+        else:
+            response[header] = storage.path(name)
+    else:
+        response = HttpResponse(FileWrapper(storage.open(name)),
+                                content_type=content_type)
+        response['Content-Length'] = storage.size(name)
+    return response
+
+
+def variation(request, app_label, model_name, field_name, variation_name, name):
+    """Serves a variation of the image `name`, rendering it on first request
+    (see the `render_on_demand` option of StdImageField). Its WebP copy is
+    served for ?format=webp.
+
+    """
+    model = get_model(app_label, model_name)
+    if model is None:
+        raise Http404
+    try:
+        field = model._meta.get_field(field_name)
+    except FieldDoesNotExist:
+        raise Http404
+    if not isinstance(field, StdImageField) or variation_name == 'size':
+        raise Http404
+    for variation in field.variations:
+        if variation['name'] == variation_name:
+            break
+    else:
+        raise Http404
+
+    if request.GET.get('format') == 'webp':
+        variation_filename = field._get_webp_filename(variation, name)
+        if variation_filename is None:
+            raise Http404
+    else:
+        variation_filename = field._get_variation_filename(variation, name)
+    if not field.storage.exists(variation_filename):
+        if not model._default_manager.filter(**{field.attname: name}).exists():
+            raise Http404
+        lock = get_lock(name)
+        lock.acquire()
+        try:
+            if not field.storage.exists(variation_filename):
+                try:
+                    field._render_variations(name, [variation])
+                except ImageTooLarge:
+                    raise Http404
+        finally:
+            lock.release()
+    return serve(field.storage, variation_filename)
@@ -4,9 +4,14 @@ import models
 
 admin.site.register(models.AdminDeleteModel)
 admin.site.register(models.AllModel)
+admin.site.register(models.AsyncModel)
+admin.site.register(models.ContentAddressedModel)
+admin.site.register(models.FormatModel)
 admin.site.register(models.MultipleFieldsModel)
+admin.site.register(models.OnDemandModel)
 admin.site.register(models.ResizeCropModel)
 admin.site.register(models.ResizeModel)
 admin.site.register(models.SimpleModel)
+admin.site.register(models.SrcsetModel)
 admin.site.register(models.ThumbnailCropModel)
 admin.site.register(models.ThumbnailModel)
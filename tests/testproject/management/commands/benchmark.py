@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+import os
+import random
+import sys
+import time
+from optparse import make_option
+from StringIO import StringIO
+
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.client import Client
+
+from stdimage import engines
+from testproject import models
+
+try:
+    import Image
+except ImportError:
+    from PIL import Image
+
+
+def make_image(size, format, seed=0):
+    """Returns the content of a synthetic image, the same for a given size,
+    format and seed
+
+    """
+    rnd = random.Random(seed)
+    tile = Image.new('RGB', (32, 32))
+    tile.putdata([(rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255))
+                  for i in range(32 * 32)])
+    img = tile.resize(size, Image.BICUBIC)
+    if format == 'GIF':
+        img = img.convert('P', palette=Image.ADAPTIVE)
+    buf = StringIO()
+    img.save(buf, format)
+    return buf.getvalue()
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks the upload, render, load and delete paths of '
+            'StdImageField on a test database with synthetic images.')
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', type='int', dest='repeat', default=20,
+                    help='Number of uploads, renders and deletes to time.'),
+        make_option('--rows', type='int', dest='rows', default=10000,
+                    help='Number of rows of the querysets to iterate.'),
+    )
+
+    formats = (('JPEG', 'jpg'), ('PNG', 'png'), ('GIF', 'gif'))
+    image_sizes = ((640, 480), (2000, 1500), (4000, 3000))
+    variations = (
+        {'name': 'thumbnail', 'width': 100, 'height': 100, 'force': True},
+        {'name': 'large', 'width': 640, 'height': 480, 'force': False},
+    )
+
+    def handle(self, **options):
+        self.repeat = options.get('repeat') or 20
+        self.rows = options.get('rows') or 10000
+        self.media_dir = os.path.join(os.path.dirname(models.__file__), 'media', 'img')
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0)
+        try:
+            self.bench_upload()
+            self.bench_render()
+            self.bench_load()
+            self.bench_delete()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            self.clean_media()
+
+    def report(self, name, value, unit):
+        sys.stdout.write('%-50s %12.3f %s\n' % (name, value, unit))
+
+    def timeit(self, func, *args):
+        start = time.time()
+        func(*args)
+        return time.time() - start
+
+    def clean_media(self):
+        if os.path.isdir(self.media_dir):
+            for name in os.listdir(self.media_dir):
+                os.remove(os.path.join(self.media_dir, name))
+
+    def upload(self, client, content):
+        for i in range(self.repeat):
+            upload = StringIO(content)
+            upload.name = 'upload.jpg'
+            client.post('/admin/testproject/allmodel/add/', {'image': upload})
+
+    def bench_upload(self):
+        User.objects.create_superuser('admin', 'admin@email.com', 'admin')
+        client = Client()
+        client.login(username='admin', password='admin')
+        for size in self.image_sizes:
+            content = make_image(size, 'JPEG')
+            elapsed = self.timeit(self.upload, client, content)
+            self.report('upload.admin.%dx%d.jpeg' % size,
+                        self.repeat / elapsed, 'images/s')
+        models.AllModel.objects.all().delete()
+        self.clean_media()
+
+    def render(self, engine, content, format, variation):
+        for i in range(self.repeat):
+            img = engine.open(content)
+            target = engines.get_size(engine.get_size(img), variation)
+            img = engine.load(img, [target])
+            engine.save(engine.resize(img, target, variation['force']), format)
+
+    def bench_render(self):
+        engine = engines.get_engine()
+        for format, ext in self.formats:
+            for size in self.image_sizes:
+                content = make_image(size, format)
+                for variation in self.variations:
+                    elapsed = self.timeit(self.render, engine, content, format,
+                                          variation)
+                    self.report('render.%dx%d.%s.%s' % (size + (ext, variation['name'])),
+                                elapsed * 1000 / self.repeat, 'ms')
+
+    def iterate(self, model, access):
+        for instance in model.objects.all():
+            if access:
+                for field in instance._meta.fields:
+                    value = getattr(instance, field.name)
+                    if hasattr(value, 'field') and value:
+                        for variation in field.variations:
+                            if variation['name'] != 'size':
+                                getattr(value, variation['name']).url
+
+    def iterate_bulk(self, model):
+        instances = list(model.objects.all())
+        for field in model._meta.fields:
+            if hasattr(field, 'variations'):
+                field.get_variation_urls(instances)
+
+    def bench_load(self):
+        for model in (models.AllModel, models.MultipleFieldsModel):
+            names = dict([(f.attname, 'img/image.jpeg') for f in model._meta.fields
+                          if hasattr(f, 'variations')])
+            for i in range(self.rows):
+                model.objects.create()
+            model.objects.update(**names)
+            for access in (False, True):
+                elapsed = self.timeit(self.iterate, model, access)
+                self.report('load.%s%s' % (model.__name__,
+                                           access and '.variation_urls' or ''),
+                            elapsed * 1000000 / self.rows, 'us/row')
+            elapsed = self.timeit(self.iterate_bulk, model)
+            self.report('load.%s.variation_urls_bulk' % model.__name__,
+                        elapsed * 1000000 / self.rows, 'us/row')
+            model.objects.all().delete()
+
+    def delete(self, instances):
+        field = models.AllModel._meta.get_field('image')
+        for instance in instances:
+            field.save_form_data(instance, '__deleted__')
+            instance.delete()
+
+    def bench_delete(self):
+        content = make_image((2000, 1500), 'JPEG')
+        instances = []
+        for i in range(self.repeat):
+            instance = models.AllModel()
+            instance.image.save('upload.jpg', ContentFile(content))
+            instances.append(models.AllModel.objects.get(pk=instance.pk))
+        elapsed = self.timeit(self.delete, instances)
+        self.report('delete.AllModel', elapsed * 1000 / self.repeat, 'ms')
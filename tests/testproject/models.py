@@ -45,3 +45,42 @@ class AllModel(models.Model):
     # all previous features in one declaration
     image = StdImageField(upload_to='img', blank=True, variations={'size': (640, 480),
                                                                    'thumbnail_size': (100, 100, True)})
+
+
+class AsyncModel(models.Model):
+    # renders the thumbnail in a background thread
+    image = StdImageField(upload_to='img', thumbnail_size=(100, 75),
+                          render_async=True,
+                          executor='stdimage.executors.ThreadExecutor')
+
+
+class OnDemandModel(models.Model):
+    # renders the thumbnail on its first request
+    image = StdImageField(upload_to='img', thumbnail_size=(100, 75),
+                          render_on_demand=True)
+
+
+class FormatModel(models.Model):
+    # renders a progressive JPEG thumbnail with a WebP copy and a PNG preview
+    image = StdImageField(upload_to='img', variations={
+        'thumbnail': (100, 75, False, {'quality': 70, 'progressive': True,
+                                       'webp': True}),
+        'preview': {'width': 1000, 'height': 1000, 'format': 'png'}})
+
+
+class SrcsetModel(models.Model):
+    # renders variations 100, 300 and 1000 pixels wide for the srcset
+    image = StdImageField(upload_to='img', srcset=(100, 300, 1000))
+
+
+class ContentAddressedModel(models.Model):
+    # identical images share their files
+    image = StdImageField(upload_to='img', thumbnail_size=(100, 75),
+                          content_addressed=True)
+    image2 = StdImageField(upload_to='img', blank=True, thumbnail_size=(100, 75),
+                           content_addressed=True)
+
+class DatedContentAddressedModel(models.Model):
+    # content addressed images are in the fixed part of upload_to
+    image = StdImageField(upload_to='img/%Y/%m', thumbnail_size=(100, 75),
+                          content_addressed=True)
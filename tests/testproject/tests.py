@@ -1,7 +1,21 @@
 import os
+import re
+from StringIO import StringIO
+from django.core.cache import cache
+from django.core.files.base import File
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.core.management import call_command
+from django.db.models import signals
+from django.forms.util import ValidationError
+from django.template import Context, Template
 from django.test import TestCase
 from django.contrib.auth.models import User
 
+from django.conf import settings
+from stdimage import StdImageField, engines, executors, locks, metadata
+from stdimage.fields import ImageTooLarge, process_images
+from stdimage.forms import StdImageFormField
 from testproject import models
 
 def img_dir():
@@ -24,7 +38,10 @@ class TestStdImage(TestCase):
                 self.fixtures[fixture_filename] = open(fixture_path, 'rb')
 
     def tearDown(self):
-        """Close all open fixtures and delete everything from media"""
+        """Close all open fixtures, delete everything from media and clear
+        the cache
+
+        """
         for fixture in self.fixtures.values():
             fixture.close()
 
@@ -33,6 +50,7 @@ class TestStdImage(TestCase):
                 os.remove(os.path.join(root, name))
             for name in dirs:
                 os.rmdir(os.path.join(root, name))
+        cache.clear()
 
 class TestWidget(TestStdImage):
     """ Functional mostly """
@@ -102,3 +120,1048 @@ class TestWidget(TestStdImage):
                                                      'image_1.gif')))
         self.assertFalse(os.path.exists(os.path.join(img_dir(),
                                                     'image_1.thumbnail.gif')))
+
+    def test_saved_once(self):
+        """ Renaming the image does not save the instance again """
+
+        saved = []
+
+        def count_saves(sender, **kwargs):
+            saved.append(kwargs['instance'])
+        signals.post_save.connect(count_saves, sender=models.SimpleModel)
+        try:
+            self.client.post('/admin/testproject/simplemodel/add/', {
+                'image': self.fixtures['100.gif']
+            })
+        finally:
+            signals.post_save.disconnect(count_saves, sender=models.SimpleModel)
+        self.assertEqual(len(saved), 1)
+        self.assertEqual(models.SimpleModel.objects.get(pk=1).image.name,
+                         'img/image_1.gif')
+
+class TestMultipleFields(TestStdImage):
+    """ The images of all the fields of a model are processed together """
+
+    def test_single_update(self):
+        """ The new names of the images are stored with one query """
+
+        from django.db import connection
+        for name in ('100.gif', '600x400.jpg', '600x400.png'):
+            self.fixtures[name].seek(0)
+        settings.DEBUG = True
+        try:
+            queries = len(connection.queries)
+            instance = models.MultipleFieldsModel(text='text')
+            instance.image1.save('image1.jpg', SimpleUploadedFile(
+                'image1.jpg', self.fixtures['600x400.jpg'].read()), save=False)
+            instance.image2.save('image2.gif', SimpleUploadedFile(
+                'image2.gif', self.fixtures['100.gif'].read()), save=False)
+            instance.image3.save('image3.png', SimpleUploadedFile(
+                'image3.png', self.fixtures['600x400.png'].read()), save=False)
+            instance.save()
+            updates = [q for q in connection.queries[queries:]
+                       if q['sql'].startswith('UPDATE')]
+        finally:
+            settings.DEBUG = False
+        self.assertEqual(len(updates), 1)
+        instance = models.MultipleFieldsModel.objects.get(pk=instance.pk)
+        self.assertEqual((instance.image1.name, instance.image2.name,
+                          instance.image3.name),
+                         ('img/image1_1.jpeg', 'img/image2_1.gif',
+                          'img/image3_1.png'))
+        self.assertTrue(os.path.exists(instance.image1.thumbnail.path))
+
+class TestResize(TestStdImage):
+    """ Variations are rendered from the uploaded image """
+
+    def get_size(self, filename):
+        try:
+            import Image
+        except ImportError:
+            from PIL import Image
+        return Image.open(os.path.join(img_dir(), filename)).size
+
+    def test_variations(self):
+        """ All variations are rendered with their own size """
+
+        self.client.post('/admin/testproject/allmodel/add/', {
+            'image': self.fixtures['600x400.jpg']
+        })
+        self.assertEqual(self.get_size('image_1.jpeg'), (600, 400))
+        self.assertEqual(self.get_size('image_1.thumbnail_size.jpeg'),
+                         (100, 100))
+        self.assertFalse(os.path.exists(os.path.join(img_dir(),
+                                                     'image_1.size.jpeg')))
+
+    def test_thumbnail_crop(self):
+        """ A cropped thumbnail has exactly the requested size """
+
+        self.client.post('/admin/testproject/thumbnailcropmodel/add/', {
+            'image': self.fixtures['600x400.png']
+        })
+        self.assertEqual(self.get_size('image_1.thumbnail.png'), (100, 100))
+
+    def test_thumbnail_fit(self):
+        """ A not cropped thumbnail fits in the requested size """
+
+        self.client.post('/admin/testproject/thumbnailmodel/add/', {
+            'image': self.fixtures['600x400.gif']
+        })
+        width, height = self.get_size('image_1.thumbnail.gif')
+        self.assertEqual(width, 100)
+        self.assertTrue(height <= 75)
+
+    def test_closed_upload(self):
+        """ Uploads closed before the instance is saved are rendered """
+
+        for upload in (File(self.fixtures['600x400.jpg']),
+                       SimpleUploadedFile('big.jpg', self.fixtures['600x400.jpg'].read())):
+            instance = models.ThumbnailModel()
+            instance.image.save('big.jpg', upload, save=False)
+            upload.close()
+            instance.save()
+            width, height = self.get_size(os.path.basename(
+                instance.image.thumbnail.name))
+            self.assertEqual(width, 100)
+
+class TestInMemoryResize(TestStdImage):
+    """ Uploads are resized in memory before they are saved """
+
+    def test_written_once(self):
+        """ The image is saved resized, and not written again """
+
+        try:
+            import Image
+        except ImportError:
+            from PIL import Image
+        upload = StringIO()
+        Image.new('RGB', (1280, 960)).save(upload, 'JPEG')
+        field = models.ResizeModel._meta.get_field('image')
+        written = []
+        field._write = lambda name, content: written.append(name)
+        try:
+            instance = models.ResizeModel()
+            instance.image.save('big.jpg', SimpleUploadedFile('big.jpg', upload.getvalue()))
+        finally:
+            del field._write
+        self.assertEqual(instance.image.name, 'img/image_1.jpeg')
+        self.assertEqual((instance.image.width, instance.image.height), (640, 480))
+        self.assertEqual(Image.open(instance.image.path).size, (640, 480))
+        self.assertFalse('img/image_1.jpeg' in written)
+
+class TestEngines(TestStdImage):
+    """ All the engines produce images with the same geometry """
+
+    sizes = [
+        {'width': 100, 'height': 75, 'force': False},
+        {'width': 100, 'height': 100, 'force': True},
+        {'width': 320, 'height': 320, 'force': False},
+        {'width': 50, 'height': 200, 'force': True},
+    ]
+
+    def get_engines(self):
+        engine_classes = [engines.PILEngine]
+        try:
+            import pyvips
+        except (ImportError, OSError):
+            pass
+        else:
+            engine_classes.append(engines.VipsEngine)
+        return [engine_class() for engine_class in engine_classes]
+
+    def test_geometry(self):
+        """ Resized images have the size given by engines.get_size """
+
+        for engine in self.get_engines():
+            for fixture_name, fixture in self.fixtures.items():
+                fixture.seek(0)
+                content = fixture.read()
+                format = engine.get_format(fixture_name)
+                img = engine.open(content)
+                img_size = engine.get_size(img)
+                for size in self.sizes:
+                    target = engines.get_size(img_size, size)
+                    img = engine.load(engine.open(content), [target])
+                    resized = engine.resize(img, target, size['force'])
+                    resized = engine.open(engine.save(resized, format))
+                    self.assertEqual(engine.get_size(resized), target)
+
+    def test_draft(self):
+        """ Big JPEG images are decoded at a reduced scale """
+
+        engine = engines.PILEngine()
+        img = engine.load(engine.open(self.fixtures['600x400.jpg'].read()),
+                          [(100, 75)])
+        self.assertEqual(img.size, (150, 100))
+
+class TestAsync(TestStdImage):
+    """ Variations are rendered by an executor """
+
+    def test_render_async(self):
+        """ The thumbnail is there once the executor is flushed """
+
+        self.client.post('/admin/testproject/asyncmodel/add/', {
+            'image': self.fixtures['600x400.jpg']
+        })
+        self.assertTrue(os.path.exists(os.path.join(img_dir(), 'image_1.jpeg')))
+        executors.flush()
+        self.assertTrue(os.path.exists(os.path.join(img_dir(),
+                                                    'image_1.thumbnail.jpeg')))
+
+class TestVariations(TestStdImage):
+    """ Variations are accessible on the image """
+
+    def test_variation_access(self):
+        """ Variations are created on first access only """
+
+        self.client.post('/admin/testproject/thumbnailmodel/add/', {
+            'image': self.fixtures['100.gif']
+        })
+        instance = models.ThumbnailModel.objects.get(pk=1)
+        self.assertFalse('_variations' in instance.image.__dict__)
+        thumbnail = instance.image.thumbnail
+        self.assertEqual(thumbnail.name, 'img/image_1.thumbnail.gif')
+        self.assertTrue(os.path.exists(thumbnail.path))
+        self.assertTrue(instance.image.thumbnail is thumbnail)
+
+    def test_unknown_variation(self):
+        """ Only declared variations are accessible """
+
+        self.client.post('/admin/testproject/thumbnailmodel/add/', {
+            'image': self.fixtures['100.gif']
+        })
+        instance = models.ThumbnailModel.objects.get(pk=1)
+        self.assertRaises(AttributeError, getattr, instance.image, 'large')
+
+    def test_variation_storage(self):
+        """ Variations share the storage of the field """
+
+        self.client.post('/admin/testproject/thumbnailmodel/add/', {
+            'image': self.fixtures['100.gif']
+        })
+        instance = models.ThumbnailModel.objects.get(pk=1)
+        field = models.ThumbnailModel._meta.get_field('image')
+        self.assertTrue(instance.image.thumbnail.storage is field.storage)
+
+class TestFingerprint(TestStdImage):
+    """ Variations are only rendered when the image or its options change """
+
+    def test_same_image(self):
+        """ Uploading the same image again does not render its variations """
+
+        self.client.post('/admin/testproject/thumbnailmodel/add/', {
+            'image': self.fixtures['600x400.jpg']
+        })
+        thumbnail = os.path.join(img_dir(), 'image_1.thumbnail.jpeg')
+        os.utime(thumbnail, (0, 0))
+        self.fixtures['600x400.jpg'].seek(0)
+        self.client.post('/admin/testproject/thumbnailmodel/1/', {
+            'image': self.fixtures['600x400.jpg']
+        })
+        self.assertEqual(os.stat(thumbnail).st_mtime, 0)
+
+    def test_other_image(self):
+        """ Uploading another image renders its variations """
+
+        self.client.post('/admin/testproject/thumbnailmodel/add/', {
+            'image': self.fixtures['600x400.jpg']
+        })
+        thumbnail = os.path.join(img_dir(), 'image_1.thumbnail.jpeg')
+        os.utime(thumbnail, (0, 0))
+        try:
+            import Image
+        except ImportError:
+            from PIL import Image
+        self.fixtures['600x400.jpg'].seek(0)
+        other = StringIO()
+        Image.open(self.fixtures['600x400.jpg']).rotate(180).save(other, 'JPEG')
+        other.seek(0)
+        other.name = 'other.jpg'
+        self.client.post('/admin/testproject/thumbnailmodel/1/', {
+            'image': other
+        })
+        self.assertNotEqual(os.stat(thumbnail).st_mtime, 0)
+
+    def test_changed_options(self):
+        """ Only the variations whose options changed are rendered """
+
+        self.client.post('/admin/testproject/allmodel/add/', {
+            'image': self.fixtures['600x400.jpg']
+        })
+        field = models.AllModel._meta.get_field('image')
+        self.assertEqual(field._render_variations('img/image_1.jpeg'), [])
+        field.thumbnail_size['width'] = 50
+        try:
+            self.assertEqual(field._render_variations('img/image_1.jpeg'),
+                             [field.thumbnail_size])
+        finally:
+            field.thumbnail_size['width'] = 100
+
+class TestFormats(TestStdImage):
+    """ Variations can have their own format and encoder options """
+
+    def test_formats(self):
+        """ Variations are written in their format, with a WebP copy """
+
+        self.client.post('/admin/testproject/formatmodel/add/', {
+            'image': self.fixtures['600x400.jpg']
+        })
+        instance = models.FormatModel.objects.get(pk=1)
+        thumbnail = instance.image.thumbnail
+        self.assertEqual(thumbnail.name, 'img/image_1.thumbnail.jpeg')
+        self.assertEqual(thumbnail.webp.name, 'img/image_1.thumbnail.webp')
+        self.assertEqual(thumbnail.webp.format, 'WEBP')
+        self.assertEqual(thumbnail.webp.width, 100)
+        preview = instance.image.preview
+        self.assertEqual(preview.name, 'img/image_1.preview.png')
+        self.assertEqual(preview.format, 'PNG')
+        self.assertEqual((preview.width, preview.height), (600, 400))
+        self.assertFalse(hasattr(preview, 'webp'))
+
+    def test_encoder_options(self):
+        """ Encoder options are given to the engine """
+
+        self.client.post('/admin/testproject/formatmodel/add/', {
+            'image': self.fixtures['600x400.jpg']
+        })
+        try:
+            import Image
+        except ImportError:
+            from PIL import Image
+        img = Image.open(os.path.join(img_dir(), 'image_1.thumbnail.jpeg'))
+        self.assertTrue(img.info.get('progressive') or img.info.get('progression'))
+
+    def test_variation_urls(self):
+        """ Urls of the WebP copies are resolved in bulk too """
+
+        self.client.post('/admin/testproject/formatmodel/add/', {
+            'image': self.fixtures['600x400.jpg']
+        })
+        instance = models.FormatModel.objects.get(pk=1)
+        field = models.FormatModel._meta.get_field('image')
+        urls = field.get_variation_urls([instance])[0]
+        self.assertEqual(urls['thumbnail_webp'], instance.image.thumbnail.webp.url)
+        self.assertEqual(urls['preview'], instance.image.preview.url)
+
+    def test_delete(self):
+        """ WebP copies are deleted with the variations """
+
+        self.client.post('/admin/testproject/formatmodel/add/', {
+            'image': self.fixtures['600x400.jpg']
+        })
+        field = models.FormatModel._meta.get_field('image')
+        field._delete_variations('img/image_1.jpeg')
+        self.assertEqual(os.listdir(img_dir()), ['image_1.jpeg'])
+
+class TestAtomicWrite(TestStdImage):
+    """ Files are replaced atomically through temporary files """
+
+    def test_write(self):
+        """ Written files replace the old ones without leaving temporary files """
+
+        field = models.SimpleModel._meta.get_field('image')
+        field._write('img/atomic.txt', 'old')
+        field._write('img/atomic.txt', 'new')
+        self.assertEqual(os.listdir(img_dir()), ['atomic.txt'])
+        self.assertEqual(open(os.path.join(img_dir(), 'atomic.txt')).read(), 'new')
+
+    def test_clean_temp_files(self):
+        """ Temporary files of interrupted writes are removed once old """
+
+        field = models.SimpleModel._meta.get_field('image')
+        field._write('img/atomic.txt', 'content')
+        old = os.path.join(img_dir(), '.stdimage-1-old.tmp')
+        recent = os.path.join(img_dir(), '.stdimage-1-recent.tmp')
+        open(old, 'w').close()
+        open(recent, 'w').close()
+        os.utime(old, (0, 0))
+        self.assertEqual(field._clean_temp_files(), 1)
+        self.assertEqual(sorted(os.listdir(img_dir())),
+                         ['.stdimage-1-recent.tmp', 'atomic.txt'])
+
+class TestLocks(TestStdImage):
+    """ Renames and renders of an image are serialized by a lock """
+
+    def test_default_lock(self):
+        """ File locks are used by default """
+
+        self.assertTrue(isinstance(locks.get_lock('img/image_1.jpeg'),
+                                   locks.FileLock))
+
+    def test_file_lock(self):
+        """ Lock files are removed when the lock is released """
+
+        lock = locks.FileLock('img/image_1.jpeg')
+        lock.acquire()
+        self.assertTrue(os.path.exists(lock.path))
+        lock.release()
+        self.assertFalse(os.path.exists(lock.path))
+        lock.acquire()
+        lock.release()
+
+    def test_cache_lock(self):
+        """ Cache locks are exclusive until released """
+
+        lock = locks.CacheLock('img/image_1.jpeg')
+        lock.acquire()
+        self.assertFalse(cache.add(lock.key, 'other'))
+        lock.release()
+        self.assertTrue(cache.add(lock.key, 'other'))
+
+    def test_lock_setting(self):
+        """ The lock class is set by STDIMAGE_LOCK """
+
+        settings.STDIMAGE_LOCK = 'stdimage.locks.CacheLock'
+        try:
+            self.assertTrue(isinstance(locks.get_lock('img/image_1.jpeg'),
+                                       locks.CacheLock))
+            self.client.post('/admin/testproject/thumbnailmodel/add/', {
+                'image': self.fixtures['100.gif']
+            })
+        finally:
+            del settings.STDIMAGE_LOCK
+        self.assertTrue(os.path.exists(os.path.join(img_dir(), 'image_1.thumbnail.gif')))
+        self.assertTrue(cache.add(locks.CacheLock('img/image_1.gif').key, 'other'))
+
+class TestOnDemand(TestStdImage):
+    """ Variations can be rendered on their first request """
+
+    def test_render_on_request(self):
+        """ The thumbnail is rendered by the first request of its url """
+
+        self.client.post('/admin/testproject/ondemandmodel/add/', {
+            'image': self.fixtures['600x400.jpg']
+        })
+        thumbnail = models.OnDemandModel.objects.get(pk=1).image.thumbnail
+        self.assertFalse(os.path.exists(thumbnail.path))
+        self.assertEqual(thumbnail.url, '/stdimage/testproject/OnDemandModel/'
+                                        'image/thumbnail/img/image_1.jpeg')
+        response = self.client.get(thumbnail.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertTrue(os.path.exists(thumbnail.path))
+        response = self.client.get(thumbnail.url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_unknown_image(self):
+        """ Only variations of stored images are rendered """
+
+        response = self.client.get('/stdimage/testproject/OnDemandModel/'
+                                   'image/thumbnail/img/image_1.jpeg')
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get('/stdimage/testproject/OnDemandModel/'
+                                   'image/large/img/image_1.jpeg')
+        self.assertEqual(response.status_code, 404)
+
+class TestRenderCommand(TestStdImage):
+    """ Variations can be regenerated with the stdimage_render command """
+
+    def test_render_missing(self):
+        """ Missing variations are rendered again """
+
+        self.client.post('/admin/testproject/thumbnailmodel/add/', {
+            'image': self.fixtures['600x400.jpg']
+        })
+        thumbnail = os.path.join(img_dir(), 'image_1.thumbnail.jpeg')
+        os.remove(thumbnail)
+        call_command('stdimage_render', 'testproject.ThumbnailModel.image',
+                     processes=1, verbosity=0)
+        self.assertTrue(os.path.exists(thumbnail))
+
+    def test_broken_image(self):
+        """ Images that can not be read are skipped, the others rendered """
+
+        for i in range(2):
+            self.fixtures['600x400.jpg'].seek(0)
+            self.client.post('/admin/testproject/thumbnailmodel/add/', {
+                'image': self.fixtures['600x400.jpg']
+            })
+        os.remove(os.path.join(img_dir(), 'image_1.jpeg'))
+        thumbnail = os.path.join(img_dir(), 'image_2.thumbnail.jpeg')
+        os.remove(thumbnail)
+        call_command('stdimage_render', 'testproject.ThumbnailModel.image',
+                     processes=1, verbosity=0, force=True)
+        self.assertTrue(os.path.exists(thumbnail))
+
+    def test_skip_up_to_date(self):
+        """ Up to date variations are not rendered again """
+
+        self.client.post('/admin/testproject/thumbnailmodel/add/', {
+            'image': self.fixtures['600x400.jpg']
+        })
+        thumbnail = os.path.join(img_dir(), 'image_1.thumbnail.jpeg')
+        os.utime(thumbnail, (0, os.stat(thumbnail).st_mtime + 10))
+        modified = os.stat(thumbnail).st_mtime
+        call_command('stdimage_render', 'testproject.ThumbnailModel',
+                     processes=1, verbosity=0)
+        self.assertEqual(os.stat(thumbnail).st_mtime, modified)
+
+class TestCleanup(TestStdImage):
+    """ Files no object references anymore are deleted """
+
+    def test_delete_instance(self):
+        """ Deleting an object deletes its image and variations """
+
+        self.client.post('/admin/testproject/thumbnailmodel/add/', {
+            'image': self.fixtures['100.gif']
+        })
+        models.ThumbnailModel.objects.get(pk=1).delete()
+        self.assertEqual(os.listdir(img_dir()), [])
+
+    def test_storage_delete(self):
+        """ Files are deleted by the storage, missing files are ignored """
+
+        field = models.ThumbnailModel._meta.get_field('image')
+        deleted = []
+        delete = field.storage.delete
+
+        def storage_delete(name):
+            deleted.append(name)
+            delete(name)
+        field.storage.delete = storage_delete
+        try:
+            field._delete('img/missing.jpeg')
+        finally:
+            del field.storage.delete
+        self.assertEqual(deleted, ['img/missing.jpeg'])
+
+    def test_replace_image(self):
+        """ Replacing an image deletes the files of the old one """
+
+        self.client.post('/admin/testproject/thumbnailmodel/add/', {
+            'image': self.fixtures['100.gif']
+        })
+        self.client.post('/admin/testproject/thumbnailmodel/1/', {
+            'image': self.fixtures['600x400.jpg']
+        })
+        self.assertEqual(sorted(os.listdir(img_dir())),
+                         ['image_1.jpeg', 'image_1.jpeg.stdimage',
+                          'image_1.thumbnail.jpeg'])
+
+    def test_gc(self):
+        """ Orphaned files are collected, referenced ones are kept """
+
+        self.client.post('/admin/testproject/thumbnailmodel/add/', {
+            'image': self.fixtures['100.gif']
+        })
+        for name in ('image_2.gif', 'image_2.thumbnail.gif', 'other.gif'):
+            open(os.path.join(img_dir(), name), 'w').close()
+        call_command('stdimage_gc', 'testproject.ThumbnailModel', min_age=0,
+                     verbosity=0)
+        self.assertEqual(sorted(os.listdir(img_dir())),
+                         ['image_1.gif', 'image_1.gif.stdimage',
+                          'image_1.thumbnail.gif', 'other.gif'])
+
+    def test_gc_foreign_files(self):
+        """ Files not named like images of the fields are kept """
+
+        self.client.post('/admin/testproject/thumbnailmodel/add/', {
+            'image': self.fixtures['100.gif']
+        })
+        for name in ('image_logo.png', 'image_2.backup.gif', 'image_2_old.gif'):
+            open(os.path.join(img_dir(), name), 'w').close()
+        call_command('stdimage_gc', 'testproject.ThumbnailModel', min_age=0,
+                     verbosity=0)
+        self.assertEqual(sorted(os.listdir(img_dir())),
+                         ['image_1.gif', 'image_1.gif.stdimage',
+                          'image_1.thumbnail.gif', 'image_2.backup.gif',
+                          'image_2_old.gif', 'image_logo.png'])
+
+    def test_gc_dry_run(self):
+        """ Nothing is deleted with --dry-run, nor recent files """
+
+        open(os.path.join(img_dir(), 'image_2.gif'), 'w').close()
+        call_command('stdimage_gc', dry_run=True, min_age=0, verbosity=0)
+        call_command('stdimage_gc', verbosity=0)
+        self.assertEqual(os.listdir(img_dir()), ['image_2.gif'])
+
+class TestMetrics(TestStdImage):
+    """ Durations of the processing stages are reported to a callback """
+
+    def test_metrics(self):
+        """ Each stage of the processing is reported """
+
+        stages = []
+
+        def callback(stage, duration, **info):
+            stages.append((stage, info.get('variation')))
+            self.assertEqual(info['field'], 'testproject.ThumbnailModel.image')
+            self.assertEqual(info['name'], 'img/image_1.jpeg')
+            self.assertTrue(duration >= 0)
+        settings.STDIMAGE_METRICS_CALLBACK = callback
+        try:
+            self.client.post('/admin/testproject/thumbnailmodel/add/', {
+                'image': self.fixtures['600x400.jpg']
+            })
+        finally:
+            del settings.STDIMAGE_METRICS_CALLBACK
+        self.assertEqual(stages, [('rename', None), ('decode', None),
+                                  ('resize', 'thumbnail'),
+                                  ('encode', 'thumbnail'),
+                                  ('write', 'thumbnail'), ('save', None)])
+
+    def test_copies_not_decoded(self):
+        """ Images whose variations are all copies are not decoded """
+
+        stages = []
+        settings.STDIMAGE_METRICS_CALLBACK = lambda stage, duration, **info: \
+            stages.append(stage)
+        try:
+            self.client.post('/admin/testproject/srcsetmodel/add/', {
+                'image': self.fixtures['100.gif']
+            })
+        finally:
+            del settings.STDIMAGE_METRICS_CALLBACK
+        self.assertTrue('write' in stages)
+        self.assertFalse('decode' in stages)
+
+class TestMetadata(TestStdImage):
+    """ Metadata of the variations are cached when they are rendered """
+
+    def test_metadata(self):
+        """ Metadata are available without reading the variation """
+
+        self.client.post('/admin/testproject/thumbnailmodel/add/', {
+            'image': self.fixtures['600x400.jpg']
+        })
+        thumbnail = models.ThumbnailModel.objects.get(pk=1).image.thumbnail
+        path = thumbnail.path
+        size = os.path.getsize(path)
+        os.remove(path)
+        self.assertTrue(thumbnail.exists)
+        self.assertEqual(thumbnail.size, size)
+        self.assertEqual((thumbnail.width, thumbnail.height), (100, 66))
+        self.assertEqual(thumbnail.format, 'JPEG')
+
+    def test_uncached_metadata(self):
+        """ Metadata missing from the cache are read from the storage """
+
+        self.client.post('/admin/testproject/thumbnailmodel/add/', {
+            'image': self.fixtures['600x400.jpg']
+        })
+        thumbnail = models.ThumbnailModel.objects.get(pk=1).image.thumbnail
+        cache.delete(metadata.get_key(thumbnail.name, thumbnail.storage))
+        self.assertEqual((thumbnail.width, thumbnail.height), (100, 66))
+        self.assertEqual(thumbnail.size, os.path.getsize(thumbnail.path))
+
+    def test_uncached_size(self):
+        """ The byte size missing from the cache does not open the file """
+
+        self.client.post('/admin/testproject/thumbnailmodel/add/', {
+            'image': self.fixtures['600x400.jpg']
+        })
+        thumbnail = models.ThumbnailModel.objects.get(pk=1).image.thumbnail
+        cache.delete(metadata.get_key(thumbnail.name, thumbnail.storage))
+
+        def storage_open(name, mode='rb'):
+            raise AssertionError('%s opened' % name)
+        thumbnail.storage.open = storage_open
+        try:
+            self.assertEqual(thumbnail.size, os.path.getsize(thumbnail.path))
+        finally:
+            del thumbnail.storage.open
+
+    def test_storage_key(self):
+        """ Files of the same name in two storages are cached apart """
+
+        other = FileSystemStorage(location=os.path.join(img_dir(), 'other'))
+        name = 'img/image_1.thumbnail.jpeg'
+        self.assertNotEqual(metadata.get_key(name, other),
+                            metadata.get_key(name, default_storage))
+
+class TestVariationUrls(TestStdImage):
+    """ Urls of variations can be resolved for many objects at once """
+
+    def test_variation_urls(self):
+        """ Bulk urls are the ones of the variation objects """
+
+        for i in range(2):
+            self.fixtures['600x400.jpg'].seek(0)
+            self.client.post('/admin/testproject/thumbnailmodel/add/', {
+                'image': self.fixtures['600x400.jpg']
+            })
+        self.client.post('/admin/testproject/thumbnailmodel/add/', {})
+        instances = list(models.ThumbnailModel.objects.order_by('pk'))
+        field = models.ThumbnailModel._meta.get_field('image')
+        urls = field.get_variation_urls(instances)
+        for instance, instance_urls in zip(instances[:2], urls):
+            self.assertEqual(instance_urls, {
+                'url': instance.image.url,
+                'thumbnail': instance.image.thumbnail.url,
+            })
+        self.assertEqual(urls[2], {})
+
+    def test_on_demand_urls(self):
+        """ Bulk urls of variations rendered on demand point to the view """
+
+        self.client.post('/admin/testproject/ondemandmodel/add/', {
+            'image': self.fixtures['600x400.jpg']
+        })
+        instance = models.OnDemandModel.objects.get(pk=1)
+        field = models.OnDemandModel._meta.get_field('image')
+        urls = field.get_variation_urls([instance])
+        self.assertEqual(urls[0]['thumbnail'], instance.image.thumbnail.url)
+
+    def test_template_tag(self):
+        """ The template tag gives the urls of each object """
+
+        self.client.post('/admin/testproject/thumbnailmodel/add/', {
+            'image': self.fixtures['600x400.jpg']
+        })
+        t = Template('{% load stdimage_tags %}'
+                     '{% variation_urls objects "image" as images %}'
+                     '{% for object, urls in images %}{{ urls.thumbnail }}{% endfor %}')
+        output = t.render(Context({
+            'objects': models.ThumbnailModel.objects.all()
+        }))
+        self.assertEqual(output, '/media/img/image_1.thumbnail.jpeg')
+
+class TestSrcset(TestStdImage):
+    """ A width ladder of variations is rendered for the srcset """
+
+    def test_srcset(self):
+        """ Variations are listed with their actual width """
+
+        self.client.post('/admin/testproject/srcsetmodel/add/', {
+            'image': self.fixtures['600x400.jpg']
+        })
+        instance = models.SrcsetModel.objects.get(pk=1)
+        self.assertEqual(instance.image.w300.height, 200)
+        self.assertEqual(instance.image.srcset,
+                         '/media/img/image_1.w100.jpeg 100w, '
+                         '/media/img/image_1.w300.jpeg 300w, '
+                         '/media/img/image_1.w1000.jpeg 600w')
+
+    def test_srcset_cold_cache(self):
+        """ Widths missing from the cache are the actual ones too """
+
+        self.client.post('/admin/testproject/srcsetmodel/add/', {
+            'image': self.fixtures['600x400.jpg']
+        })
+        cache.clear()
+        self.assertEqual(models.SrcsetModel.objects.get(pk=1).image.srcset,
+                         '/media/img/image_1.w100.jpeg 100w, '
+                         '/media/img/image_1.w300.jpeg 300w, '
+                         '/media/img/image_1.w1000.jpeg 600w')
+
+    def test_render_order(self):
+        """ Ladder variations are rendered from bigger variations """
+
+        sources = []
+
+        class Engine(engines.PILEngine):
+            def resize(self, img, size, crop=False):
+                sources.append((img.size, size))
+                return engines.PILEngine.resize(self, img, size, crop)
+        field = StdImageField(upload_to='img', variations={'large': (500, 500)},
+                              srcset=(320,), engine=Engine())
+        field.set_attributes_from_name('image')
+        name = field.storage.save('img/ladder.jpg', File(self.fixtures['600x400.jpg']))
+        field._render_variations(name)
+        self.assertEqual(sources, [((600, 400), (500, 333)),
+                                   ((500, 333), (320, 213))])
+
+    def test_template_tag(self):
+        """ The template tag renders an img element """
+
+        self.client.post('/admin/testproject/srcsetmodel/add/', {
+            'image': self.fixtures['600x400.jpg']
+        })
+        t = Template('{% load stdimage_tags %}'
+                     '{% srcset_img object.image "100vw" "A photo" %}')
+        output = t.render(Context({
+            'object': models.SrcsetModel.objects.get(pk=1)
+        }))
+        self.assertEqual(output, '<img src="/media/img/image_1.w1000.jpeg" '
+                         'srcset="/media/img/image_1.w100.jpeg 100w, '
+                         '/media/img/image_1.w300.jpeg 300w, '
+                         '/media/img/image_1.w1000.jpeg 600w" sizes="100vw" '
+                         'width="600" height="400" alt="A photo"/>')
+
+class TestUpload(TestStdImage):
+    """ Uploads are checked reading the image header only """
+
+    def get_upload(self, name):
+        self.fixtures[name].seek(0)
+        return SimpleUploadedFile(name, self.fixtures[name].read())
+
+    def test_form_field(self):
+        """ The size and format of the image are kept on the upload """
+
+        f = StdImageFormField().clean(self.get_upload('600x400.png'))
+        self.assertEqual(f.image_size, (600, 400))
+        self.assertEqual(f.image_format, 'PNG')
+
+    def test_invalid_image(self):
+        """ Files that are not images are rejected """
+
+        self.assertRaises(ValidationError, StdImageFormField().clean,
+                          SimpleUploadedFile('image.jpg', 'not an image'))
+
+    def test_truncated_image(self):
+        """ Images whose data is cut are rejected """
+
+        data = self.get_upload('600x400.png').read()
+        self.assertRaises(ValidationError, StdImageFormField().clean,
+                          SimpleUploadedFile('image.png', data[:len(data) // 2]))
+
+    def test_truncated_image_saved(self):
+        """ Images that can not be decoded leave no file under their final
+        name """
+
+        data = self.get_upload('600x400.jpg').read()
+        instance = models.ThumbnailModel()
+        instance.image.save('image.jpg', SimpleUploadedFile(
+            'image.jpg', data[:len(data) // 2]), save=False)
+        filename = instance.image.name
+        self.assertRaises(IOError, instance.save)
+        self.assertEqual(models.ThumbnailModel.objects.get().image.name, filename)
+        self.assertTrue(os.path.exists(os.path.join(img_dir(), os.path.basename(filename))))
+        self.assertFalse(os.path.exists(os.path.join(img_dir(), 'image_1.jpeg')))
+
+    def test_dimensions(self):
+        """ The size of the upload is kept by the saved file """
+
+        instance = models.SimpleModel()
+        field = models.SimpleModel._meta.get_field('image')
+        upload = field.formfield().clean(self.get_upload('600x400.jpg'))
+        # Like a model form, then Model.save
+        field.save_form_data(instance, upload)
+        field.pre_save(instance, True)
+        os.remove(instance.image.path)
+        upload.file.close()
+        self.assertEqual((instance.image.width, instance.image.height),
+                         (600, 400))
+
+    def test_temporary_upload(self):
+        """ Temporary uploads are moved into place """
+
+        instance = models.SimpleModel()
+        field = models.SimpleModel._meta.get_field('image')
+        upload = TemporaryUploadedFile('image.jpg', 'image/jpeg', 0, None)
+        upload.write(self.get_upload('600x400.jpg').read())
+        upload.size = upload.tell()
+        upload = field.formfield().clean(upload)
+        path = upload.temporary_file_path()
+        field.save_form_data(instance, upload)
+        field.pre_save(instance, True)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual((instance.image.width, instance.image.height),
+                         (600, 400))
+
+class TestBudget(TestStdImage):
+    """ Images over the pixel or byte budget are not decoded in full """
+
+    def get_upload(self, name):
+        self.fixtures[name].seek(0)
+        return SimpleUploadedFile(name, self.fixtures[name].read())
+
+    def test_form_field(self):
+        """ Uploads over the budget are rejected from their header """
+
+        self.assertRaises(ValidationError, StdImageFormField(max_pixels=1000).clean,
+                          self.get_upload('600x400.png'))
+        self.assertRaises(ValidationError, StdImageFormField(max_bytes=1000).clean,
+                          self.get_upload('600x400.png'))
+        f = StdImageFormField(max_pixels=600 * 400).clean(self.get_upload('600x400.png'))
+        self.assertEqual(f.image_size, (600, 400))
+
+    def test_reduced_decoding(self):
+        """ JPEG images over the budget are decoded at a reduced scale """
+
+        self.client.post('/admin/testproject/thumbnailmodel/add/', {
+            'image': self.fixtures['600x400.jpg']
+        })
+        field = models.ThumbnailModel._meta.get_field('image')
+        field._delete_variations('img/image_1.jpeg')
+        decoded = []
+
+        def callback(stage, duration, **info):
+            if stage == 'decode':
+                decoded.append(info['size'])
+        field.max_pixels = 200 * 150
+        settings.STDIMAGE_METRICS_CALLBACK = callback
+        try:
+            field._render_variations('img/image_1.jpeg')
+        finally:
+            field.max_pixels = None
+            del settings.STDIMAGE_METRICS_CALLBACK
+        self.assertTrue(decoded[0][0] * decoded[0][1] <= 200 * 150)
+        thumbnail = models.ThumbnailModel.objects.get(pk=1).image.thumbnail
+        self.assertEqual(thumbnail.width, 100)
+
+    def test_rejected(self):
+        """ Other images over the budget are not rendered """
+
+        self.client.post('/admin/testproject/thumbnailmodel/add/', {
+            'image': self.fixtures['600x400.png']
+        })
+        field = models.ThumbnailModel._meta.get_field('image')
+        settings.STDIMAGE_MAX_PIXELS = 200 * 150
+        try:
+            self.assertRaises(ImageTooLarge, field._render_variations,
+                              'img/image_1.png', force=True)
+        finally:
+            del settings.STDIMAGE_MAX_PIXELS
+
+class TestBulkProcess(TestStdImage):
+    """ Images of objects saved in bulk are processed together """
+
+    def create(self, count):
+        """ Saves objects without processing their images """
+        signals.post_save.disconnect(sender=models.ThumbnailModel,
+                                     dispatch_uid='stdimage.process_images')
+        try:
+            for i in range(count):
+                self.fixtures['600x400.jpg'].seek(0)
+                instance = models.ThumbnailModel()
+                instance.image.save('upload.jpg', SimpleUploadedFile(
+                    'upload.jpg', self.fixtures['600x400.jpg'].read()))
+        finally:
+            signals.post_save.connect(process_images, sender=models.ThumbnailModel,
+                                      dispatch_uid='stdimage.process_images')
+        return list(models.ThumbnailModel.objects.order_by('pk'))
+
+    def test_bulk_process(self):
+        """ Images are renamed, their names stored and variations rendered """
+
+        instances = self.create(3)
+        field = models.ThumbnailModel._meta.get_field('image')
+        self.assertEqual(field.bulk_process(instances, processes=1), 3)
+        for instance in models.ThumbnailModel.objects.all():
+            self.assertEqual(instance.image.name, 'img/image_%d.jpeg' % instance.pk)
+            self.assertTrue(os.path.exists(instance.image.thumbnail.path))
+        self.assertEqual(field.bulk_process(instances, processes=1), 0)
+
+    def test_pool(self):
+        """ Variations are rendered by a pool of processes """
+
+        instances = self.create(2)
+        field = models.ThumbnailModel._meta.get_field('image')
+        self.assertEqual(field.bulk_process(instances, processes=2), 2)
+        for instance in instances:
+            self.assertTrue(os.path.exists(instance.image.thumbnail.path))
+
+class TestContentAddressed(TestStdImage):
+    """ Identical images share their files """
+
+    def upload(self):
+        self.fixtures['600x400.jpg'].seek(0)
+        self.client.post('/admin/testproject/contentaddressedmodel/add/', {
+            'image': self.fixtures['600x400.jpg']
+        })
+
+    def test_shared(self):
+        """ The second upload of an image reuses its files """
+
+        self.upload()
+        first = models.ContentAddressedModel.objects.get(pk=1).image
+        self.assertTrue(re.match(r'img/([0-9a-f]{2})/\1[0-9a-f]{38}\.jpeg$', first.name))
+        os.utime(first.thumbnail.path, (0, 0))
+        self.upload()
+        second = models.ContentAddressedModel.objects.get(pk=2).image
+        self.assertEqual(second.name, first.name)
+        self.assertEqual(os.stat(second.thumbnail.path).st_mtime, 0)
+        directory = os.path.dirname(first.path)
+        self.assertEqual(len(os.listdir(directory)), 3)
+        self.assertEqual(os.listdir(img_dir()), [os.path.basename(directory)])
+
+    def test_same_image_twice(self):
+        """ Fields of an object storing the same image share its file """
+
+        data = self.fixtures['600x400.jpg'].read()
+        instance = models.ContentAddressedModel()
+        instance.image.save('image.jpg', SimpleUploadedFile('image.jpg', data), save=False)
+        instance.image2.save('image.jpg', SimpleUploadedFile('image.jpg', data), save=False)
+        instance.save()
+        instance = models.ContentAddressedModel.objects.get()
+        self.assertEqual(instance.image2.name, instance.image.name)
+        self.assertTrue(os.path.exists(instance.image.thumbnail.path))
+
+    def test_dated_directory(self):
+        """ Images uploaded on different dates share their files """
+
+        field = StdImageField(upload_to='img/%Y/%m', content_addressed=True)
+        field.set_attributes_from_name('image')
+        name = field._get_final_filename(None, 'img/2011/05/image.jpg', 'content')
+        self.assertEqual(field._get_final_filename(None, 'img/2012/01/image.jpg', 'content'),
+                         name)
+        self.assertTrue(re.match(r'img/([0-9a-f]{2})/\1[0-9a-f]{38}\.jpeg$', name))
+
+    def test_delete(self):
+        """ Shared files are deleted with the last object using them """
+
+        self.upload()
+        self.upload()
+        image = models.ContentAddressedModel.objects.get(pk=1).image
+        models.ContentAddressedModel.objects.get(pk=1).delete()
+        self.assertTrue(os.path.exists(image.path))
+        models.ContentAddressedModel.objects.get(pk=2).delete()
+        self.assertFalse(os.path.exists(image.path))
+        self.assertFalse(os.path.exists(image.thumbnail.path))
+
+    def test_gc(self):
+        """ Unreferenced content addressed files are collected """
+
+        self.upload()
+        image = models.ContentAddressedModel.objects.get(pk=1).image
+        orphan = os.path.join(os.path.dirname(image.path), image.name[4:6] + '0' * 38 + '.jpeg')
+        open(orphan, 'w').close()
+        call_command('stdimage_gc', 'testproject.ContentAddressedModel',
+                     min_age=0, verbosity=0)
+        self.assertFalse(os.path.exists(orphan))
+        self.assertTrue(os.path.exists(image.thumbnail.path))
+
+    def test_gc_foreign_files(self):
+        """ Files of two characters subdirectories not named after a hash are
+        kept """
+
+        self.upload()
+        image = models.ContentAddressedModel.objects.get(pk=1).image
+        foreign = [os.path.join(img_dir(), 'en', 'about.jpg'),
+                   os.path.join(os.path.dirname(image.path), 'notes.txt'),
+                   os.path.join(os.path.dirname(image.path), image.name[4:6] + 'x' * 38 + '.jpeg')]
+        os.mkdir(os.path.join(img_dir(), 'en'))
+        for name in foreign:
+            open(name, 'w').close()
+        call_command('stdimage_gc', 'testproject.ContentAddressedModel',
+                     min_age=0, verbosity=0)
+        for name in foreign:
+            self.assertTrue(os.path.exists(name))
+
+    def test_gc_dated(self):
+        """ Content addressed images of dated upload directories are
+        collected """
+
+        instance = models.DatedContentAddressedModel()
+        instance.image.save('image.jpg', File(self.fixtures['600x400.jpg']))
+        image = models.DatedContentAddressedModel.objects.get().image
+        self.assertTrue(re.match(r'img/([0-9a-f]{2})/\1[0-9a-f]{38}\.jpeg$', image.name))
+        orphan = os.path.join(os.path.dirname(image.path), image.name[4:6] + '0' * 38 + '.jpeg')
+        open(orphan, 'w').close()
+        call_command('stdimage_gc', 'testproject.DatedContentAddressedModel',
+                     min_age=0, verbosity=0)
+        self.assertFalse(os.path.exists(orphan))
+        self.assertTrue(os.path.exists(image.path))
+        self.assertTrue(os.path.exists(image.thumbnail.path))
+
+    def test_gc_reused(self):
+        """ Files used again while they are collected are kept """
+
+        from stdimage.management.commands import stdimage_gc
+        self.upload()
+        image = models.ContentAddressedModel.objects.get(pk=1).image
+        models.ContentAddressedModel.objects.update(image='')
+
+        def get_lock(key):
+            # The object is saved again once the database has been read
+            models.ContentAddressedModel.objects.update(image=image.name)
+            return locks.get_lock(key)
+        stdimage_gc.get_lock = get_lock
+        try:
+            call_command('stdimage_gc', 'testproject.ContentAddressedModel',
+                         min_age=0, verbosity=0)
+        finally:
+            stdimage_gc.get_lock = locks.get_lock
+        self.assertTrue(os.path.exists(image.path))
+        self.assertTrue(os.path.exists(image.thumbnail.path))